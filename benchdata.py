@@ -0,0 +1,67 @@
+import os
+import json
+import skusources
+
+# Hand-made resource_skus records and retail price items in the shape of the Azure
+# responses, replayed by the benchmark. They are not recorded pages: 20 SKU records and
+# 70 price items with placeholder meterIds, far smaller than the real payloads
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench', 'fixtures')
+# Items per prices page, as served by the prices API
+PRICES_PAGE_SIZE = 100
+
+def load_fixture(name, fixtures_dir=None):
+    """Read a JSON fixture"""
+
+    with open(os.path.join(fixtures_dir or FIXTURES_DIR, name)) as fixture:
+        return json.load(fixture)
+
+def scale_fixtures(records, items, regions, skus):
+    """Scale the fixture virtual machine SKUs and their prices up to regions x skus
+
+    Every scaled SKU copies the capabilities of a fixture one and every
+    scaled region copies the prices of a fixture region, so the result keeps
+    the shape of the fixtures. The other resource types are kept as they are.
+    """
+
+    templates = {}
+    for record in records:
+        if record['resourceType'] == 'virtualMachines':
+            templates.setdefault(record['name'], record)
+    template_items = {}
+    template_region = items[0]['armRegionName'] if items else None
+    for item in items:
+        if item['armRegionName'] == template_region:
+            template_items.setdefault(item['armSkuName'], []).append(item)
+    names = sorted(templates)
+    scaled_records = [record for record in records if record['resourceType'] != 'virtualMachines']
+    scaled_items = []
+    meter = 0
+    for sku in range(skus):
+        template = names[sku % len(names)]
+        name = template if sku < len(names) else f"{template}_bench{sku}"
+        for region_number in range(regions):
+            region = f"benchregion{region_number}"
+            record = dict(templates[template], name=name, locations=json.dumps([region]),
+                          locationInfo=json.dumps([{'location': region, 'zones': ['1', '2', '3'], 'zoneDetails': []}]))
+            scaled_records.append(record)
+            for item in template_items.get(template, ()):
+                meter += 1
+                scaled_items.append(dict(item, armSkuName=name, armRegionName=region, location=region,
+                                         meterId=f"bench-meter-{meter}", skuId=f"bench-sku-{meter}"))
+    return scaled_records, scaled_items
+
+def benchmark_data(regions=None, skus=None, fixtures_dir=None, synthetic=False):
+    """Return the resource_skus records and price items to benchmark with
+
+    synthetic generates them with skusources, otherwise the fixtures are
+    replayed, scaled up when regions or skus are given.
+    """
+
+    if synthetic:
+        records = skusources.SyntheticSkuSource(regions or len(skusources.REGIONS), skus or 200).records
+        return records, skusources.synthetic_price_items(records)
+    records = load_fixture('resource_skus.json', fixtures_dir)
+    items = load_fixture('retail_prices.json', fixtures_dir)
+    if regions or skus:
+        records, items = scale_fixtures(records, items, regions or 1, skus or 1)
+    return records, items
@@ -0,0 +1,177 @@
+import logging
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl, urlencode, quote
+import benchdata
+
+# Path of the prices API, the api-version query parameter is accepted but ignored
+PRICES_PATH = '/api/retail/prices'
+
+class TokenBucket:
+    """Allow rate requests per second with bursts of up to burst requests"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Take a token, returning 0 or the seconds until one is available"""
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+class PricesHandler(BaseHTTPRequestHandler):
+    """Serve $skip paged Items/NextPageLink responses with the latency, throttling and failures of the server"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        parts = urlsplit(self.path)
+        if parts.path != PRICES_PATH:
+            return self.send_json(404, {'Error': {'Code': 'NotFound', 'Message': parts.path}})
+        server.count('requests')
+        if server.latency:
+            time.sleep(max(0.0, random.gauss(server.latency, server.latency_jitter)))
+        wait = server.bucket.take() if server.bucket else 0
+        if wait or random.random() < server.throttle_probability:
+            server.count('throttled')
+            retry_after = max(1, math.ceil(wait or server.retry_after))
+            return self.send_json(429, {'Error': {'Code': 'TooManyRequests'}}, {'Retry-After': str(retry_after)})
+        if random.random() < server.drop_probability:
+            server.count('dropped')
+            self.close_connection = True
+            return
+        if random.random() < server.fail_probability:
+            server.count('failed')
+            return self.send_json(random.choice((500, 502, 503)), {'Error': {'Code': 'InternalError'}})
+
+        query = [(k, v) for k, v in parse_qsl(parts.query) if k != '$skip']
+        skip = int(dict(parse_qsl(parts.query)).get('$skip', 0))
+        page = server.items[skip:skip + server.page_size]
+        next_url = None
+        if skip + server.page_size < len(server.items):
+            next_query = urlencode(query + [('$skip', str(skip + server.page_size))], safe="$'", quote_via=quote)
+            next_url = f"http://{self.headers.get('Host')}{PRICES_PATH}?{next_query}"
+        body = {'BillingCurrency': 'USD', 'CustomerEntityId': 'Default', 'CustomerEntityType': 'Retail',
+                'Items': page, 'NextPageLink': next_url, 'Count': len(page)}
+        if random.random() < server.truncate_probability:
+            server.count('truncated')
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload[:len(payload) // 2])
+            self.close_connection = True
+            return
+        server.count('pages')
+        self.send_json(200, body)
+
+    def send_json(self, status, body, headers=None):
+        """Send a JSON response"""
+
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+class PricesServer(ThreadingHTTPServer):
+    """Stand-in for the Azure Retail Prices API serving price items from memory"""
+
+    daemon_threads = True
+
+    def __init__(self, address, items, page_size=benchdata.PRICES_PAGE_SIZE, latency=0.0, latency_jitter=0.0,
+                 rate=None, burst=None, throttle_probability=0.0, retry_after=1.0,
+                 fail_probability=0.0, drop_probability=0.0, truncate_probability=0.0):
+        super().__init__(address, PricesHandler)
+        self.items = items
+        self.page_size = page_size
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.bucket = TokenBucket(rate, burst or max(1, int(rate))) if rate else None
+        self.throttle_probability = throttle_probability
+        self.retry_after = retry_after
+        self.fail_probability = fail_probability
+        self.drop_probability = drop_probability
+        self.truncate_probability = truncate_probability
+        self.stats = {'requests': 0, 'pages': 0, 'throttled': 0, 'failed': 0, 'dropped': 0, 'truncated': 0}
+        self.stats_lock = threading.Lock()
+
+    def count(self, outcome):
+        """Count a request outcome"""
+
+        with self.stats_lock:
+            self.stats[outcome] += 1
+
+    @property
+    def base_url(self):
+        """Return the base url to put in RATES_API_BASE_URL"""
+
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+def start_server(items, host='127.0.0.1', port=0, **options):
+    """Start a PricesServer on a background thread and return it, port 0 picks a free port"""
+
+    server = PricesServer((host, port), items, **options)
+    threading.Thread(target=server.serve_forever, name='mockprices', daemon=True).start()
+    logging.info(f"Serving {len(items)} price items on {server.base_url}")
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve fixture or generated prices as the Azure Retail Prices API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--fixtures', help="directory of resource_skus.json and retail_prices.json")
+    parser.add_argument('--regions', type=int, help="scale the fixture prices up to this many regions")
+    parser.add_argument('--skus', type=int, help="scale up to this many virtual machine SKUs per region")
+    parser.add_argument('--synthetic', action='store_true', help="generate the prices instead of replaying the fixtures")
+    parser.add_argument('--page-size', type=int, default=benchdata.PRICES_PAGE_SIZE)
+    parser.add_argument('--latency', type=float, default=0.0, help="mean seconds added to every response")
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help="standard deviation of the added latency")
+    parser.add_argument('--rate', type=float, help="requests per second served before answering 429")
+    parser.add_argument('--burst', type=int, help="requests served at once before the rate applies")
+    parser.add_argument('--throttle-probability', type=float, default=0.0, help="share of requests answered 429")
+    parser.add_argument('--retry-after', type=float, default=1.0, help="Retry-After seconds of random 429s")
+    parser.add_argument('--fail-probability', type=float, default=0.0, help="share of requests answered 5xx")
+    parser.add_argument('--drop-probability', type=float, default=0.0, help="share of connections closed without a response")
+    parser.add_argument('--truncate-probability', type=float, default=0.0, help="share of pages cut off half way")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', level='INFO')
+    _, items = benchdata.benchmark_data(args.regions, args.skus, args.fixtures, args.synthetic)
+    server = PricesServer((args.host, args.port), items, page_size=args.page_size,
+                          latency=args.latency, latency_jitter=args.latency_jitter,
+                          rate=args.rate, burst=args.burst,
+                          throttle_probability=args.throttle_probability, retry_after=args.retry_after,
+                          fail_probability=args.fail_probability, drop_probability=args.drop_probability,
+                          truncate_probability=args.truncate_probability)
+    logging.info(f"Serving {len(items)} price items, set RATES_API_BASE_URL={server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    logging.info(f"Served: {server.stats}")
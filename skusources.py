@@ -0,0 +1,205 @@
+import logging
+import gzip
+import json
+import random
+
+# Real region names used first by the synthetic source, further regions are numbered
+REGIONS = ['eastus', 'eastus2', 'westus', 'westus2', 'westus3', 'centralus', 'northcentralus', 'southcentralus',
+           'westcentralus', 'canadacentral', 'canadaeast', 'brazilsouth', 'northeurope', 'westeurope', 'uksouth',
+           'ukwest', 'francecentral', 'germanywestcentral', 'norwayeast', 'swedencentral', 'switzerlandnorth',
+           'polandcentral', 'italynorth', 'spaincentral', 'uaenorth', 'qatarcentral', 'israelcentral',
+           'southafricanorth', 'centralindia', 'southindia', 'westindia', 'eastasia', 'southeastasia',
+           'japaneast', 'japanwest', 'koreacentral', 'koreasouth', 'australiaeast', 'australiasoutheast',
+           'australiacentral', 'newzealandnorth', 'mexicocentral']
+# Virtual machine families: (family, size pattern, vCPU sizes, GB of memory per vCPU, hourly price per vCPU,
+# premium storage, accelerated networking, vCPUs per GPU or None)
+VM_FAMILIES = [
+    ('standardDSv5Family', 'D{}s_v5', (2, 4, 8, 16, 32, 48, 64, 96), 4, 0.048, True, True, None),
+    ('standardDv5Family', 'D{}_v5', (2, 4, 8, 16, 32, 48, 64, 96), 4, 0.048, False, True, None),
+    ('standardDASv5Family', 'D{}as_v5', (2, 4, 8, 16, 32, 48, 64, 96), 4, 0.043, True, True, None),
+    ('standardESv5Family', 'E{}s_v5', (2, 4, 8, 16, 20, 32, 48, 64, 96, 104), 8, 0.063, True, True, None),
+    ('standardEASv5Family', 'E{}as_v5', (2, 4, 8, 16, 20, 32, 48, 64, 96, 112), 8, 0.0565, True, True, None),
+    ('standardFSv2Family', 'F{}s_v2', (2, 4, 8, 16, 32, 48, 64, 72), 2, 0.0423, True, True, None),
+    ('standardBSFamily', 'B{}ms', (1, 2, 4, 8, 12, 16, 20), 4, 0.0416, True, False, None),
+    ('standardLSv3Family', 'L{}s_v3', (8, 16, 32, 48, 64, 80), 8, 0.078, True, True, None),
+    ('standardMSFamily', 'M{}s', (8, 16, 32, 64, 128), 28, 0.22, True, True, None),
+    ('standardNCSv3Family', 'NC{}s_v3', (6, 12, 24), 18, 0.51, True, False, 6),
+]
+
+def sku_json_text(value):
+    """Encode a field the way StackQL returns nested resource_skus fields, as JSON text"""
+
+    return json.dumps(value)
+
+def vm_capabilities(vcpus, memory_gb, premium_io, accelerated_networking, gpus, rng):
+    """Return the capabilities array of a virtual machine size, values as text like the API"""
+
+    capabilities = {
+        'MaxResourceVolumeMB': 0 if premium_io else vcpus * 8192, 'OSVhdSizeMB': 1047552, 'vCPUs': vcpus,
+        'MemoryPreservingMaintenanceSupported': 'True', 'HyperVGenerations': 'V1,V2', 'MemoryGB': memory_gb,
+        'MaxDataDiskCount': min(64, vcpus * 4), 'CpuArchitectureType': 'x64', 'LowPriorityCapable': 'True',
+        'PremiumIO': str(premium_io), 'VMDeploymentTypes': 'IaaS', 'vCPUsAvailable': vcpus, 'vCPUsPerCore': 2,
+        'CombinedTempDiskAndCachedIOPS': vcpus * 9000, 'CombinedTempDiskAndCachedReadBytesPerSecond': vcpus * 62500000,
+        'CombinedTempDiskAndCachedWriteBytesPerSecond': vcpus * 31250000, 'UncachedDiskIOPS': vcpus * 1600,
+        'UncachedDiskBytesPerSecond': vcpus * 43750000, 'EphemeralOSDiskSupported': str(premium_io),
+        'EncryptionAtHostSupported': 'True', 'CapacityReservationSupported': str(rng.random() < 0.9),
+        'AcceleratedNetworkingEnabled': str(accelerated_networking), 'RdmaEnabled': 'False',
+        'MaxNetworkInterfaces': max(2, min(8, vcpus // 2)), 'HibernationSupported': str(rng.random() < 0.3),
+        'UltraSSDAvailable': str(premium_io and rng.random() < 0.5), 'TrustedLaunchDisabled': 'False',
+        'DiskControllerTypes': 'SCSI, NVMe', 'SupportedEphemeralOSDiskPlacements': 'ResourceDisk,CacheDisk',
+        'ACUs': 195,
+    }
+    if gpus:
+        capabilities['GPUs'] = gpus
+    return [{'name': name, 'value': str(value)} for name, value in capabilities.items()]
+
+def location_info(region, zones=('1', '2', '3')):
+    """Return the locationInfo of a record available in region"""
+
+    return sku_json_text([{'location': region, 'zones': list(zones), 'zoneDetails': []}])
+
+def sku_record(resource_type, name, region, capabilities, family='null', size='null', tier='null', restrictions=()):
+    """Return a resource_skus record shaped like the ones StackQL returns"""
+
+    return {'apiVersions': 'null', 'capabilities': sku_json_text(capabilities), 'capacity': 'null', 'costs': 'null',
+            'family': family, 'kind': 'null', 'locationInfo': location_info(region), 'locations': sku_json_text([region]),
+            'name': name, 'resourceType': resource_type, 'restrictions': sku_json_text(list(restrictions)),
+            'size': size, 'tier': tier}
+
+class RecordsSkuSource:
+    """resource_skus source answering from records held in memory"""
+
+    cacheable = False
+
+    def __init__(self, records):
+        self.records = records
+
+    def fetch(self, resource_type=None):
+        """Return the records of one resource type, or all of them"""
+
+        if resource_type is None:
+            return list(self.records)
+        return [record for record in self.records if record.get('resourceType') == resource_type]
+
+class FileSkuSource(RecordsSkuSource):
+    """resource_skus source reading the records stored in a JSON file, gzipped if its name ends in .gz"""
+
+    def __init__(self, path):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as records_file:
+            super().__init__(json.load(records_file))
+        logging.info(f"Read {len(self.records)} resource_skus records from {path}")
+
+class SyntheticSkuSource(RecordsSkuSource):
+    """resource_skus source generating regions x skus virtual machine records with realistic capabilities
+
+    Sizes are taken from VM_FAMILIES in turn, then repeated with a numbered
+    suffix on their last token. Every region also gets a few disk,
+    availability set, host and snapshot records, and a share of the virtual
+    machine records carries a zone restriction. The same arguments always
+    generate the same records.
+    """
+
+    def __init__(self, regions=len(REGIONS), skus=200, seed=0):
+        rng = random.Random(seed)
+        sizes = []
+        for family, pattern, vcpu_sizes, memory_per_vcpu, price_per_vcpu, premium_io, accelerated, vcpus_per_gpu in VM_FAMILIES:
+            for vcpus in vcpu_sizes:
+                sizes.append((family, pattern.format(vcpus), vcpus, vcpus * memory_per_vcpu, premium_io, accelerated,
+                              vcpus // vcpus_per_gpu if vcpus_per_gpu else None))
+        region_names = (REGIONS + [f"region{number}" for number in range(len(REGIONS), regions)])[:regions]
+        records = []
+        for sku in range(skus):
+            family, size, vcpus, memory_gb, premium_io, accelerated, gpus = sizes[sku % len(sizes)]
+            if sku >= len(sizes):
+                # One token, so the price skuNames keep the 2, 3 (Spot) and 4 (Low Priority) word shapes
+                size = f"{size}x{sku // len(sizes)}"
+            capabilities = vm_capabilities(vcpus, memory_gb, premium_io, accelerated, gpus, rng)
+            for region in region_names:
+                restrictions = ()
+                if rng.random() < 0.05:
+                    restrictions = [{'type': 'Zone', 'values': [region],
+                                     'restrictionInfo': {'locations': [region], 'zones': ['3']},
+                                     'reasonCode': 'NotAvailableForSubscription'}]
+                records.append(sku_record('virtualMachines', f"Standard_{size}", region, capabilities,
+                                          family, size, 'Standard', restrictions))
+        for region in region_names:
+            records.append(sku_record('disks', 'Premium_LRS', region,
+                                      [{'name': 'MaxSizeGiB', 'value': '4'}, {'name': 'MaxIOps', 'value': '120'},
+                                       {'name': 'MaxBandwidthMBps', 'value': '25'}], size='P1', tier='Premium'))
+            records.append(sku_record('disks', 'StandardSSD_LRS', region,
+                                      [{'name': 'MaxSizeGiB', 'value': '4'}, {'name': 'MaxIOps', 'value': '500'},
+                                       {'name': 'MaxBandwidthMBps', 'value': '60'}], size='E1', tier='Standard'))
+            records.append(sku_record('availabilitySets', 'Aligned', region,
+                                      [{'name': 'MaximumPlatformFaultDomainCount', 'value': '3'}]))
+            records.append(sku_record('hostGroups/hosts', 'DSv5-Type1', region,
+                                      [{'name': 'Cores', 'value': '64'}, {'name': 'vCPUsPerCore', 'value': '2'},
+                                       {'name': 'vCPUs', 'value': '128'}, {'name': 'SupportsAutoplacement', 'value': 'True'}],
+                                      family='standardDSv5Family'))
+            records.append(sku_record('snapshots', 'Standard_ZRS', region, [{'name': 'MaxSizeGiB', 'value': '32767'}],
+                                      tier='Standard'))
+        super().__init__(records)
+        logging.info(f"Generated {len(records)} resource_skus records for {len(region_names)} regions x {skus} sizes")
+
+class StackQLSkuSource:
+    """resource_skus source querying Azure through a StackQL session"""
+
+    cacheable = True
+
+    def __init__(self, stackql, subscription_id):
+        self.stackql = stackql
+        self.subscription_id = subscription_id
+
+    def fetch(self, resource_type=None):
+        """Return the records of one resource type, or all of them"""
+
+        query = """select * from azure.compute.resource_skus
+               where subscriptionId = '%s'""" % (self.subscription_id)
+        if resource_type:
+            query += " and resourceType = '%s'" % (resource_type)
+        return self.stackql.execute(query + ";")
+
+def synthetic_price_items(records, seed=0):
+    """Return retail price items for the virtual machine records, shaped like the prices API items
+
+    Each size and region gets Linux and Windows on-demand prices with savings
+    plans, spot and low priority prices and 1 and 3 year reservations.
+    """
+
+    rng = random.Random(seed)
+    price_per_vcpu = {family: price for family, _, _, _, price, _, _, _ in VM_FAMILIES}
+    region_factor = {}
+    items = []
+    for record in records:
+        if record.get('resourceType') != 'virtualMachines':
+            continue
+        name = record['name']
+        region = json.loads(record['locations'])[0]
+        capabilities = {capability['name']: capability['value'] for capability in json.loads(record['capabilities'])}
+        factor = region_factor.setdefault(region, 1 + rng.random() * 0.3)
+        base = round(int(capabilities['vCPUs']) * price_per_vcpu.get(record['family'], 0.05) * factor, 4)
+        series = record['family'].replace('standard', '').replace('Family', '')
+        short = name.replace('Standard_', '').replace('_', ' ')
+        linux = f"Virtual Machines {series} Series"
+        for sku_name, product, unit, price_type, term, savings in (
+                (short, linux, base, 'Consumption', None, True),
+                (short + ' Spot', linux, round(base * 0.2, 6), 'Consumption', None, False),
+                (short + ' Low Priority', linux, round(base * 0.2, 6), 'Consumption', None, False),
+                (short, linux + ' Windows', round(base * 1.9, 4), 'Consumption', None, True),
+                (short + ' Spot', linux + ' Windows', round(base * 0.475, 6), 'Consumption', None, False),
+                (short, linux, round(base * 8760 * 0.6, 2), 'Reservation', '1 Year', False),
+                (short, linux, round(base * 8760 * 3 * 0.4, 2), 'Reservation', '3 Years', False)):
+            meter = len(items) + 1
+            item = {'currencyCode': 'USD', 'tierMinimumUnits': 0.0, 'retailPrice': unit, 'unitPrice': unit,
+                    'armRegionName': region, 'location': region, 'effectiveStartDate': '2024-05-01T00:00:00Z',
+                    'meterId': f"synthetic-meter-{meter}", 'meterName': sku_name, 'productId': f"synthetic-product-{series}",
+                    'skuId': f"synthetic-sku-{meter}", 'productName': product, 'skuName': sku_name,
+                    'serviceName': 'Virtual Machines', 'serviceId': 'DZH313Z7MMC8', 'serviceFamily': 'Compute',
+                    'unitOfMeasure': '1 Hour', 'type': price_type, 'isPrimaryMeterRegion': True, 'armSkuName': name}
+            if term:
+                item['reservationTerm'] = term
+            if savings:
+                item['savingsPlan'] = [{'unitPrice': round(unit * 0.45, 6), 'retailPrice': round(unit * 0.45, 6), 'term': '3 Years'},
+                                       {'unitPrice': round(unit * 0.68, 6), 'retailPrice': round(unit * 0.68, 6), 'term': '1 Year'}]
+            items.append(item)
+    return items
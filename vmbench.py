@@ -0,0 +1,144 @@
+import psycopg2
+import logging
+import argparse
+import io
+import json
+import os
+import resource
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, quote
+import urllib3
+from requests.adapters import HTTPAdapter
+import vmsamp
+import skusources
+import benchdata
+
+class FixturePricesAdapter(HTTPAdapter):
+    """Transport adapter serving retail price items as $skip paged prices API responses"""
+
+    def __init__(self, items, page_size=benchdata.PRICES_PAGE_SIZE):
+        super().__init__()
+        self.items = items
+        self.page_size = page_size
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        query = [(k, v) for k, v in parse_qsl(parts.query) if k != '$skip']
+        skip = int(dict(parse_qsl(parts.query)).get('$skip', 0))
+        page = self.items[skip:skip + self.page_size]
+        next_url = None
+        if skip + self.page_size < len(self.items):
+            next_query = urlencode(query + [('$skip', str(skip + self.page_size))], safe="$'", quote_via=quote)
+            next_url = urlunsplit(parts._replace(query=next_query))
+        body = json.dumps({'BillingCurrency': 'USD', 'CustomerEntityId': 'Default', 'CustomerEntityType': 'Retail',
+                           'Items': page, 'NextPageLink': next_url, 'Count': len(page)}).encode('utf-8')
+        raw = urllib3.HTTPResponse(body=io.BytesIO(body), headers={'Content-Type': 'application/json'},
+                                   status=200, preload_content=False, decode_content=False)
+        return self.build_response(request, raw)
+
+def pg_stat_statements_available(cursor):
+    """Tell whether the pg_stat_statements extension is installed in the benchmark database"""
+
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements')")
+    return cursor.fetchone()[0]
+
+def statement_seconds(cursor):
+    """Return the server side execution time recorded by pg_stat_statements, in seconds"""
+
+    try:
+        cursor.execute("SELECT COALESCE(SUM(total_exec_time), 0) / 1000 FROM pg_stat_statements")
+    except psycopg2.errors.UndefinedColumn:
+        # before PostgreSQL 13 the column was total_time
+        cursor.execute("SELECT COALESCE(SUM(total_time), 0) / 1000 FROM pg_stat_statements")
+    return float(cursor.fetchone()[0])
+
+def peak_rss_mb():
+    """Return the peak resident set size of the benchmark process so far"""
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_benchmark(regions=None, skus=None, stages=None, page_size=benchdata.PRICES_PAGE_SIZE, fixtures_dir=None, prices_url=None,
+                  synthetic=False):
+    """Run the pipeline stages one after another on the fixtures and return the measurements of each
+
+    With prices_url the rates are crawled from that server, such as a
+    mockprices one, instead of being replayed in process.
+    """
+
+    records, items = benchdata.benchmark_data(regions, skus, fixtures_dir, synthetic)
+    logging.info(f"Benchmarking with {len(records)} resource_skus records and {len(items)} price items")
+
+    vmsamp.utc_timezone = 'UTC'
+    vmsamp.subscription_id = 'benchmark'
+    vmsamp.sku_source = skusources.RecordsSkuSource(records)
+    vmsamp.RATES_CRAWL_MODE = 'full'
+    if prices_url:
+        vmsamp.RATES_API_URL = prices_url.rstrip('/') + '/api/retail/prices?api-version=2023-01-01-preview'
+    else:
+        vmsamp.get_rates_session().mount(vmsamp.RATES_API_URL.split('?')[0], FixturePricesAdapter(items, page_size))
+
+    stats_connection = psycopg2.connect(host=os.environ.get('POSTGRES_HOST', 'db1'),
+                                        database = os.environ['POSTGRES_DB'],
+                                        user = os.environ['POSTGRES_USER'],
+                                        password = os.environ['POSTGRES_PASSWORD'])
+    stats_connection.autocommit = True
+    stats_cursor = stats_connection.cursor()
+    with_statements = pg_stat_statements_available(stats_cursor)
+    if not with_statements:
+        logging.warning("pg_stat_statements is not installed, reporting no server side statement time")
+
+    results = []
+    vmsamp.reset_resource_skus()
+    vmsamp.reset_run_metrics()
+    if vmsamp.TABLE_LOAD_MODE == 'shadow':
+        vmsamp.connect_to_db()
+        try:
+            vmsamp.create_shadow_schemas()
+        finally:
+            vmsamp.close_db_connection()
+    for name, (stage, _) in vmsamp.pipeline_stages().items():
+        if stages and name not in stages:
+            continue
+        if with_statements:
+            stats_cursor.execute("SELECT pg_stat_statements_reset()")
+        vmsamp.run_stage(name, stage)
+        metrics = vmsamp.run_metrics.get(name, {})
+        seconds = metrics.get('seconds', 0.0)
+        rows = metrics.get('rows', 0)
+        results.append({'stage': name, 'seconds': round(seconds, 3), 'rows': rows,
+                        'rows_per_second': round(rows / seconds, 1) if seconds else None,
+                        'payload_bytes': metrics.get('payload_bytes', 0),
+                        'statement_seconds': round(statement_seconds(stats_cursor), 3) if with_statements else None,
+                        'peak_rss_mb': round(peak_rss_mb(), 1)})
+    stats_connection.close()
+    return results
+
+def print_report(results):
+    """Print the measurements of the stages as a table"""
+
+    print(f"{'stage':<18}{'seconds':>10}{'rows':>12}{'rows/s':>12}{'stmt s':>10}{'peak RSS MB':>13}")
+    for result in results:
+        statement = '-' if result['statement_seconds'] is None else f"{result['statement_seconds']:.3f}"
+        throughput = '-' if result['rows_per_second'] is None else f"{result['rows_per_second']:.0f}"
+        print(f"{result['stage']:<18}{result['seconds']:>10.3f}{result['rows']:>12}{throughput:>12}"
+              f"{statement:>10}{result['peak_rss_mb']:>13.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay the hand-made Azure fixtures through the vmsamp stages against a local PostgreSQL")
+    parser.add_argument('--regions', type=int, help="scale the virtual machine SKUs and prices up to this many regions")
+    parser.add_argument('--skus', type=int, help="scale up to this many virtual machine SKUs per region")
+    parser.add_argument('--synthetic', action='store_true', help="generate the SKUs and prices instead of replaying the fixtures")
+    parser.add_argument('--stage', action='append', dest='stages', help="only run this stage, may be repeated")
+    parser.add_argument('--page-size', type=int, default=benchdata.PRICES_PAGE_SIZE, help="items per replayed prices page")
+    parser.add_argument('--fixtures', help="directory of resource_skus.json and retail_prices.json")
+    parser.add_argument('--prices-url', help="crawl the rates from this base url, e.g. of mockprices, instead of replaying them")
+    parser.add_argument('--json', help="also write the measurements to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', level=os.environ.get('LOGLEVEL', 'WARNING'))
+    results = run_benchmark(args.regions, args.skus, args.stages, args.page_size, args.fixtures, args.prices_url,
+                            args.synthetic)
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as report:
+            json.dump(results, report, indent=1)
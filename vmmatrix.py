@@ -0,0 +1,157 @@
+import psycopg2
+import logging
+import os
+import threading
+import numpy as np
+
+# Channel vmsamp notifies once vm_pricing holds the rows of a new run
+REFRESH_CHANNEL = 'vm_pricing_refreshed'
+# vm_pricing columns usable as the denominator of a price ratio
+RATIO_COLUMNS = ('vcpus', 'instance_memory')
+
+class PriceMatrix:
+    """vm_pricing held as NumPy columns, name and location dictionary encoded
+
+    names[name_codes] and locations[location_codes] give back the text of
+    every row, every other column is a float64 array with NaN for NULL.
+    """
+
+    def __init__(self, columns, rows):
+        self.size = len(rows)
+        values = dict(zip(columns, zip(*rows))) if rows else {column: () for column in columns}
+        self.names, self.name_codes = np.unique(np.array(values.pop('name'), dtype=object).astype(str), return_inverse=True)
+        self.locations, self.location_codes = np.unique(np.array(values.pop('location'), dtype=object).astype(str), return_inverse=True)
+        self.columns = {column: np.array(column_values, dtype=np.float64) for column, column_values in values.items()}
+
+    def column(self, column):
+        """Return the float64 array of a numeric column"""
+
+        try:
+            return self.columns[column.lower()]
+        except KeyError:
+            raise ValueError(f"Unknown vm_pricing column {column}") from None
+
+    def select(self, min_vcpus=None, max_vcpus=None, min_memory=None, max_memory=None, locations=None, names=None):
+        """Return the mask of the rows within the vCPU and memory ranges and among the given locations and names"""
+
+        mask = np.ones(self.size, dtype=bool)
+        vcpus = self.columns['vcpus']
+        memory = self.columns['instance_memory']
+        if min_vcpus is not None:
+            mask &= vcpus >= min_vcpus
+        if max_vcpus is not None:
+            mask &= vcpus <= max_vcpus
+        if min_memory is not None:
+            mask &= memory >= min_memory
+        if max_memory is not None:
+            mask &= memory <= max_memory
+        if locations is not None:
+            mask &= np.isin(self.location_codes, np.flatnonzero(np.isin(self.locations, list(locations))))
+        if names is not None:
+            mask &= np.isin(self.name_codes, np.flatnonzero(np.isin(self.names, list(names))))
+        return mask
+
+    def rows(self, indexes, **values):
+        """Return the name and location of the rows at indexes with the matching entries of values"""
+
+        return [dict(name=str(self.names[self.name_codes[i]]), location=str(self.locations[self.location_codes[i]]),
+                     **{key: float(array[n]) for key, array in values.items()})
+                for n, i in enumerate(indexes)]
+
+    def smallest(self, scores, mask, n):
+        """Return the indexes of the n rows of mask with the smallest finite scores, in order"""
+
+        candidates = np.flatnonzero(mask & np.isfinite(scores))
+        if n < len(candidates):
+            candidates = candidates[np.argpartition(scores[candidates], n)[:n]]
+        return candidates[np.argsort(scores[candidates], kind='stable')]
+
+    def cheapest(self, n=10, price='linux_on_demand_cost', per='vcpus', **filters):
+        """Return the n rows with the lowest price per vCPU or per GB of memory"""
+
+        if per.lower() not in RATIO_COLUMNS:
+            raise ValueError(f"per must be one of {RATIO_COLUMNS}")
+        prices = self.column(price)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = prices / self.column(per)
+        ratios[self.column(per) <= 0] = np.nan
+        indexes = self.smallest(ratios, self.select(**filters), n)
+        return self.rows(indexes, price=prices[indexes], ratio=ratios[indexes])
+
+    def spot_discount(self, os_type='linux'):
+        """Return the fraction of the on-demand price saved by spot for every row, NaN where either is missing"""
+
+        on_demand = self.column(f"{os_type}_on_demand_cost")
+        spot = self.column(f"{os_type}_spot_cost")
+        with np.errstate(divide='ignore', invalid='ignore'):
+            discounts = 1 - spot / on_demand
+        discounts[on_demand <= 0] = np.nan
+        return discounts
+
+    def deepest_spot_discounts(self, n=10, os_type='linux', min_discount=None, **filters):
+        """Return the n rows where spot saves the largest fraction of the on-demand price"""
+
+        discounts = self.spot_discount(os_type)
+        mask = self.select(**filters)
+        if min_discount is not None:
+            mask &= discounts >= min_discount
+        indexes = self.smallest(-discounts, mask, n)
+        return self.rows(indexes, discount=discounts[indexes])
+
+
+connection = None
+matrix = None
+matrix_lock = threading.Lock()
+
+def connect_to_db():
+    """Open the connection loading vm_pricing and listening for new pipeline runs"""
+
+    global connection
+    connection = psycopg2.connect(host=os.environ.get('POSTGRES_HOST', 'db1'),
+                                  database = os.environ['POSTGRES_DB'],
+                                  user = os.environ['POSTGRES_USER'],
+                                  password = os.environ['POSTGRES_PASSWORD'])
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute("LISTEN %s" % REFRESH_CHANNEL)
+    logging.debug('pg connected')
+
+def load_matrix():
+    """Read vm_pricing into a new PriceMatrix"""
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT * FROM vm_pricing")
+        columns = [column.name for column in cursor.description]
+        loaded = PriceMatrix(columns, cursor.fetchall())
+    logging.info(f"Loaded {loaded.size} vm_pricing rows into the price matrix")
+    return loaded
+
+def current_matrix():
+    """Return the price matrix, reloading it when a pipeline run refreshed vm_pricing since the last load"""
+
+    global matrix
+    with matrix_lock:
+        if connection is None or connection.closed:
+            connect_to_db()
+            matrix = None
+        connection.poll()
+        if connection.notifies:
+            connection.notifies.clear()
+            matrix = None
+        if matrix is None:
+            try:
+                matrix = load_matrix()
+            except psycopg2.Error as e:
+                logging.error(f"Error in loading vm_pricing into the price matrix:{e}")
+                raise
+        return matrix
+
+def cheapest(n=10, price='linux_on_demand_cost', per='vcpus', **filters):
+    """Return the n virtual machine sizes and regions with the lowest price per vCPU or per GB of memory"""
+
+    return current_matrix().cheapest(n, price, per, **filters)
+
+def deepest_spot_discounts(n=10, os_type='linux', min_discount=None, **filters):
+    """Return the n virtual machine sizes and regions where spot saves the most over on-demand"""
+
+    return current_matrix().deepest_spot_discounts(n, os_type, min_discount, **filters)
@@ -0,0 +1,121 @@
+import psycopg2
+import logging
+import os
+import threading
+from functools import lru_cache
+
+# Channel vmsamp notifies once a pipeline run recorded new prices
+REFRESH_CHANNEL = 'vm_pricing_refreshed'
+# 'snapshot' reads vm_pricing_history, 'delta' reads vm_pricing_versions, as written by vmsamp
+VM_PRICING_HISTORY_MODE = os.environ.get('VM_PRICING_HISTORY_MODE', 'snapshot')
+# Number of lookups kept by each in-process cache
+PRICE_CACHE_SIZE = int(os.environ.get('PRICE_CACHE_SIZE', '4096'))
+
+# Latest snapshot at or before ts, a backward probe of vm_pricing_history_name_location_run
+SNAPSHOT_AT_QUERY = """
+    SELECT * FROM vm_pricing_history
+    WHERE name = %(name)s AND location = %(location)s AND run_timestamp <= %(ts)s
+    ORDER BY run_timestamp DESC LIMIT 1"""
+SNAPSHOT_SERIES_QUERY = """
+    SELECT * FROM vm_pricing_history
+    WHERE name = %(name)s AND location = %(location)s AND run_timestamp BETWEEN %(start)s AND %(end)s
+    ORDER BY run_timestamp"""
+# Version valid at ts, a backward probe of vm_pricing_versions_name_location_valid_from
+VERSION_AT_QUERY = """
+    SELECT * FROM vm_pricing_versions
+    WHERE name = %(name)s AND location = %(location)s AND valid_from <= %(ts)s
+      AND (valid_to IS NULL OR valid_to > %(ts)s)
+    ORDER BY valid_from DESC LIMIT 1"""
+VERSION_SERIES_QUERY = """
+    SELECT * FROM vm_pricing_versions
+    WHERE name = %(name)s AND location = %(location)s AND valid_from <= %(end)s
+      AND (valid_to IS NULL OR valid_to > %(start)s)
+    ORDER BY valid_from"""
+
+connection = None
+connection_lock = threading.Lock()
+
+def connect_to_db():
+    """Open the connection shared by the lookups and listening for new pipeline runs"""
+
+    global connection
+    connection = psycopg2.connect(host=os.environ.get('POSTGRES_HOST', 'db1'),
+                                  database = os.environ['POSTGRES_DB'],
+                                  user = os.environ['POSTGRES_USER'],
+                                  password = os.environ['POSTGRES_PASSWORD'])
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute("SET TIME ZONE 'UTC'")
+        cursor.execute("LISTEN %s" % REFRESH_CHANNEL)
+    logging.debug('pg connected')
+
+def fetch_rows(query, params):
+    """Run a lookup query and return its rows as dicts keyed by column name"""
+
+    with connection_lock:
+        if connection is None or connection.closed:
+            connect_to_db()
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            columns = [column.name for column in cursor.description]
+            return tuple(dict(zip(columns, row)) for row in cursor.fetchall())
+
+@lru_cache(maxsize=PRICE_CACHE_SIZE)
+def cached_price_at(name, location, ts):
+    """Return the cached row of name in location at ts"""
+
+    query = VERSION_AT_QUERY if VM_PRICING_HISTORY_MODE == 'delta' else SNAPSHOT_AT_QUERY
+    rows = fetch_rows(query, {'name': name, 'location': location, 'ts': ts})
+    return rows[0] if rows else None
+
+@lru_cache(maxsize=PRICE_CACHE_SIZE)
+def cached_price_series(name, location, start, end):
+    """Return the cached rows of name in location between start and end"""
+
+    query = VERSION_SERIES_QUERY if VM_PRICING_HISTORY_MODE == 'delta' else SNAPSHOT_SERIES_QUERY
+    return fetch_rows(query, {'name': name, 'location': location, 'start': start, 'end': end})
+
+def refresh_cache():
+    """Forget the cached lookups when a pipeline run recorded new prices since the last lookup"""
+
+    with connection_lock:
+        if connection is None or connection.closed:
+            # runs finished while disconnected were not notified
+            connect_to_db()
+            clear_cache()
+        connection.poll()
+        if connection.notifies:
+            connection.notifies.clear()
+            clear_cache()
+
+def price_at(name, location, ts):
+    """Return the vm_pricing row of a virtual machine size in a region as recorded at ts, None if unknown"""
+
+    refresh_cache()
+    row = cached_price_at(name, location, ts)
+    return dict(row) if row else None
+
+def price_series(name, location, start, end):
+    """Return the vm_pricing rows of a virtual machine size in a region recorded between start and end"""
+
+    refresh_cache()
+    return [dict(row) for row in cached_price_series(name, location, start, end)]
+
+def clear_cache():
+    """Forget the cached lookups, after a pipeline run recorded new prices"""
+
+    cached_price_at.cache_clear()
+    cached_price_series.cache_clear()
+
+def close_db_connection():
+    """Close the connection shared by the lookups"""
+
+    global connection
+    with connection_lock:
+        if connection is not None:
+            try:
+                connection.close()
+                logging.info("PG Database connection closed")
+            except psycopg2.Error as e:
+                logging.error(f"Error in closing database connection:{e}")
+            connection = None
@@ -0,0 +1,188 @@
+import psycopg2
+import logging
+import os
+import threading
+import heapq
+import bisect
+from operator import itemgetter
+
+# Channel vmsamp notifies once vm_pricing holds the rows of a new run
+REFRESH_CHANNEL = 'vm_pricing_refreshed'
+# Pricing model -> vm_pricing column holding its hourly price
+PRICING_MODELS = {
+    'linux_on_demand': 'linux_on_demand_cost',
+    'linux_savings_plan_1_year': 'linux_savings_price_1_year',
+    'linux_savings_plan_3_years': 'linux_savings_price_3_years',
+    'linux_reservation_1_year': 'linux_reservation_1_year',
+    'linux_reservation_3_years': 'linux_reservation_3_years',
+    'linux_spot': 'linux_spot_cost',
+    'windows_on_demand': 'windows_on_demand_cost',
+    'windows_savings_plan_1_year': 'windows_savings_price_1_year',
+    'windows_savings_plan_3_years': 'windows_savings_price_3_years',
+    'windows_reservation_1_year': 'windows_reservation_1_year',
+    'windows_reservation_3_years': 'windows_reservation_3_years',
+    'windows_spot': 'windows_spot_cost',
+}
+# Boolean virtualMachines capabilities a request can require, one bit each
+FEATURES = ('PremiumIO', 'AcceleratedNetworkingEnabled', 'EncryptionAtHostSupported', 'EphemeralOSDiskSupported',
+            'HibernationSupported', 'UltraSSDAvailable', 'RdmaEnabled', 'LowPriorityCapable',
+            'CapacityReservationSupported', 'MemoryPreservingMaintenanceSupported')
+FEATURE_BITS = {feature.lower(): 1 << bit for bit, feature in enumerate(FEATURES)}
+
+OFFERS_QUERY = """
+    SELECT p.*, vm.gpus, %s
+    FROM vm_pricing p
+    INNER JOIN virtualmachines vm ON vm.name = p.name AND vm.locations = p.location
+    """ % ", ".join("vm.%s" % feature for feature in FEATURES)
+
+def feature_mask(features):
+    """Return the bitmask of a collection of feature names"""
+
+    mask = 0
+    for feature in features:
+        try:
+            mask |= FEATURE_BITS[feature.lower()]
+        except KeyError:
+            raise ValueError(f"Unknown feature {feature}, expected one of {FEATURES}") from None
+    return mask
+
+class OfferGroup:
+    """Offers of one region and pricing model with the same features, bucketed by shape
+
+    Each bucket holds the price-sorted offers of one (vcpus, memory, gpus)
+    shape, the buckets are kept in vcpus order. The group maxima let a request
+    skip the whole group, and a request only walks the buckets of shapes that
+    fit instead of every cheaper, smaller offer.
+    """
+
+    def __init__(self, location, pricing_model, mask, offers):
+        self.location = location
+        self.pricing_model = pricing_model
+        self.mask = mask
+        buckets = {}
+        for offer in offers:
+            buckets.setdefault((offer[2], offer[3], offer[4]), []).append(offer)
+        self.shapes = sorted(buckets)
+        self.shape_vcpus = [shape[0] for shape in self.shapes]
+        self.buckets = [sorted(buckets[shape], key=itemgetter(0)) for shape in self.shapes]
+        self.max_vcpus = max(offer[2] for offer in offers)
+        self.max_memory = max(offer[3] for offer in offers)
+        self.max_gpus = max(offer[4] for offer in offers)
+
+    def can_fit(self, min_vcpus, min_memory, min_gpus, required_mask):
+        """Tell whether some offer of the group may meet the requirements"""
+
+        return (self.mask & required_mask == required_mask and self.max_vcpus >= min_vcpus
+                and self.max_memory >= min_memory and self.max_gpus >= min_gpus)
+
+    def fits(self, min_vcpus, min_memory, min_gpus):
+        """Yield the offers meeting the numeric requirements in price order"""
+
+        start = bisect.bisect_left(self.shape_vcpus, min_vcpus)
+        fitting = [self.buckets[position] for position in range(start, len(self.shapes))
+                   if self.shapes[position][1] >= min_memory and self.shapes[position][2] >= min_gpus]
+        for offer in heapq.merge(*fitting, key=itemgetter(0)):
+            yield offer + (self.location, self.pricing_model)
+
+class Recommender:
+    """Offer groups of vm_pricing joined with virtualMachines, indexed by region and pricing model"""
+
+    def __init__(self, columns, rows):
+        index = {column: position for position, column in enumerate(columns)}
+        grouped = {}
+        self.size = 0
+        for row in rows:
+            mask = 0
+            for feature in FEATURES:
+                if row[index[feature.lower()]]:
+                    mask |= FEATURE_BITS[feature.lower()]
+            for pricing_model, price_column in PRICING_MODELS.items():
+                price = row[index[price_column]]
+                if price is None:
+                    continue
+                # (price, name, vcpus, memory, gpus)
+                offer = (float(price), row[index['name']], row[index['vcpus']] or 0,
+                         float(row[index['instance_memory']] or 0), row[index['gpus']] or 0)
+                grouped.setdefault((row[index['location']], pricing_model, mask), []).append(offer)
+                self.size += 1
+        self.groups = {}
+        for (location, pricing_model, mask), offers in grouped.items():
+            self.groups.setdefault((location, pricing_model), []).append(OfferGroup(location, pricing_model, mask, offers))
+
+    def recommend(self, min_vcpus=0, min_memory=0, min_gpus=0, features=(), regions=None, pricing_models=None, n=1):
+        """Return the n cheapest offers meeting the requirements, cheapest first
+
+        Offers are walked in price order across the groups that can fit and
+        the walk stops at the n-th fit.
+        """
+
+        required_mask = feature_mask(features)
+        if pricing_models is None:
+            pricing_models = PRICING_MODELS
+        if regions is None:
+            keys = [key for key in self.groups if key[1] in pricing_models]
+        else:
+            keys = [(region, pricing_model) for region in regions for pricing_model in pricing_models]
+        candidates = [group.fits(min_vcpus, min_memory, min_gpus)
+                      for key in keys for group in self.groups.get(key, ())
+                      if group.can_fit(min_vcpus, min_memory, min_gpus, required_mask)]
+        recommendations = []
+        for price, name, vcpus, memory, gpus, location, pricing_model in heapq.merge(*candidates, key=itemgetter(0)):
+            recommendations.append(dict(name=name, location=location, pricing_model=pricing_model,
+                                        price=price, vcpus=vcpus, memory_gb=memory, gpus=gpus))
+            if len(recommendations) == n:
+                break
+        return recommendations
+
+
+connection = None
+recommender = None
+recommender_lock = threading.Lock()
+
+def connect_to_db():
+    """Open the connection loading the offers and listening for new pipeline runs"""
+
+    global connection
+    connection = psycopg2.connect(host=os.environ.get('POSTGRES_HOST', 'db1'),
+                                  database = os.environ['POSTGRES_DB'],
+                                  user = os.environ['POSTGRES_USER'],
+                                  password = os.environ['POSTGRES_PASSWORD'])
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute("LISTEN %s" % REFRESH_CHANNEL)
+    logging.debug('pg connected')
+
+def load_recommender():
+    """Read the offers of vm_pricing and virtualMachines into a new Recommender"""
+
+    with connection.cursor() as cursor:
+        cursor.execute(OFFERS_QUERY)
+        columns = [column.name for column in cursor.description]
+        loaded = Recommender(columns, cursor.fetchall())
+    logging.info(f"Loaded {loaded.size} offers into the recommender")
+    return loaded
+
+def current_recommender():
+    """Return the recommender, reloading it when a pipeline run refreshed vm_pricing since the last load"""
+
+    global recommender
+    with recommender_lock:
+        if connection is None or connection.closed:
+            connect_to_db()
+            recommender = None
+        connection.poll()
+        if connection.notifies:
+            connection.notifies.clear()
+            recommender = None
+        if recommender is None:
+            try:
+                recommender = load_recommender()
+            except psycopg2.Error as e:
+                logging.error(f"Error in loading the offers into the recommender:{e}")
+                raise
+        return recommender
+
+def recommend(min_vcpus=0, min_memory=0, min_gpus=0, features=(), regions=None, pricing_models=None, n=1):
+    """Return the n cheapest virtual machine sizes, regions and pricing models meeting the requirements"""
+
+    return current_recommender().recommend(min_vcpus, min_memory, min_gpus, features, regions, pricing_models, n)
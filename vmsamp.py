@@ -1,23 +1,132 @@
 import psycopg2
 import logging
 from pystackql import StackQL
+import skusources
 import time
 import os
 import json
+import gzip
+import hashlib
+import random
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from decimal import Decimal
 import requests
 import schedule
+import threading
+from contextlib import contextmanager
+import functools
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util import make_headers
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, quote
+try:
+    import ijson
+except ImportError:
+    # without ijson rates pages are decoded whole, still without a json round trip
+    ijson = None
+try:
+    import prometheus_client
+except ImportError:
+    # the metrics endpoint is only served when prometheus_client is installed
+    prometheus_client = None
+
+# 'combined' pulls resource_skus once per run and partitions it by resourceType,
+# 'per_type' runs one StackQL query per resource type
+SKU_FETCH_MODE = os.environ.get('SKU_FETCH_MODE', 'combined')
+# On-disk cache of the StackQL resource_skus results, fresh for SKU_CACHE_TTL seconds
+SKU_CACHE_DIR = os.environ.get('SKU_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'vmsamp'))
+SKU_CACHE_TTL = int(os.environ.get('SKU_CACHE_TTL', '21600'))
+SKU_CACHE_BYPASS = os.environ.get('SKU_CACHE_BYPASS', '').lower() in ('1', 'true', 'yes')
+# Where resource_skus records come from: 'stackql' queries Azure, 'file' reads the
+# records stored in SKU_SOURCE_FILE, 'synthetic' generates SKU_SYNTHETIC_REGIONS x
+# SKU_SYNTHETIC_SKUS virtual machine records
+SKU_SOURCE = os.environ.get('SKU_SOURCE', 'stackql')
+SKU_SOURCES = ('stackql', 'file', 'synthetic')
+SKU_SOURCE_FILE = os.environ.get('SKU_SOURCE_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                 'bench', 'fixtures', 'resource_skus.json'))
+SKU_SYNTHETIC_REGIONS = int(os.environ.get('SKU_SYNTHETIC_REGIONS', '60'))
+SKU_SYNTHETIC_SKUS = int(os.environ.get('SKU_SYNTHETIC_SKUS', '200'))
+# 'insert' loads through jsonb_array_elements INSERT ... SELECT, 'copy' flattens
+# the records in Python and streams them with COPY ... FROM STDIN
+LOAD_METHOD = os.environ.get('LOAD_METHOD', 'insert')
+# 'truncate' empties and refills each table in place, 'shadow' loads a staging
+# copy and swaps it in atomically so readers always see a complete snapshot
+TABLE_LOAD_MODE = os.environ.get('TABLE_LOAD_MODE', 'truncate')
+STAGING_SCHEMA = 'vmsamp_staging'
+RETIRED_SCHEMA = 'vmsamp_retired'
+# 'snapshot' appends every vm_pricing row to vm_pricing_history on each run,
+# 'delta' only records the rows that changed in vm_pricing_versions
+VM_PRICING_HISTORY_MODE = os.environ.get('VM_PRICING_HISTORY_MODE', 'snapshot')
+# Months of vm_pricing_history kept, counting the current one; 0 keeps every partition
+VM_PRICING_HISTORY_RETENTION_MONTHS = int(os.environ.get('VM_PRICING_HISTORY_RETENTION_MONTHS', '0'))
+# Port of the Prometheus metrics endpoint of the scheduler process, unset serves none
+METRICS_PORT = os.environ.get('METRICS_PORT')
+# Log the plan of the vm_pricing join before running it, to check it uses the managed indexes
+EXPLAIN_VM_PRICING = os.environ.get('EXPLAIN_VM_PRICING', 'off') == 'on'
+# Number of pipeline stages run concurrently by mainflow, 1 runs them in sequence
+PIPELINE_WORKERS = int(os.environ.get('PIPELINE_WORKERS', '6'))
+# Scheme and host of the prices API, point it at a stand-in such as mockprices to test the crawl locally
+RATES_API_BASE_URL = os.environ.get('RATES_API_BASE_URL', 'https://prices.azure.com')
+# API url for the first page of Azure prices
+RATES_API_URL = RATES_API_BASE_URL.rstrip('/') + "/api/retail/prices?api-version=2023-01-01-preview"
+# 'full' crawls the whole retail catalogue, 'filtered' pushes a $filter for
+# the virtual machine prices of the regions in virtualMachines to the API
+RATES_CRAWL_MODE = os.environ.get('RATES_CRAWL_MODE', 'full')
+# Currency requested from the API in the filtered crawl mode
+RATES_CURRENCY_CODE = os.environ.get('RATES_CURRENCY_CODE', 'USD')
+# 'full' truncates and reloads azure_rates, 'incremental' only fetches price
+# points from the effectiveStartDate high-water mark of the last completed crawl
+# onwards and upserts them, keeping the newest price point of each natural key
+RATES_SYNC_MODE = os.environ.get('RATES_SYNC_MODE', 'full')
+# Days between the full reloads an incremental sync falls back to, picking up meters
+# published with an effectiveStartDate below the high-water mark; 0 never reconciles
+RATES_RECONCILE_DAYS = float(os.environ.get('RATES_RECONCILE_DAYS', '7'))
+# Number of rates pages kept in flight while earlier pages are inserted
+RATES_FETCH_CONCURRENCY = int(os.environ.get('RATES_FETCH_CONCURRENCY', '4'))
+# Hours a rates crawl checkpoint stays resumable, older ones restart the crawl; above
+# the daily schedule so the next scheduled run resumes the crawl of a failed one
+RATES_CHECKPOINT_MAX_AGE = float(os.environ.get('RATES_CHECKPOINT_MAX_AGE', '36'))
+# Attempts per rates page and the bounds of the exponential backoff between them, in seconds
+RATES_RETRY_ATTEMPTS = int(os.environ.get('RATES_RETRY_ATTEMPTS', '6'))
+RATES_RETRY_BASE_DELAY = float(os.environ.get('RATES_RETRY_BASE_DELAY', '1'))
+RATES_RETRY_MAX_DELAY = float(os.environ.get('RATES_RETRY_MAX_DELAY', '60'))
+# Requests in flight to one host of the prices API
+RATES_HOST_CONCURRENCY = int(os.environ.get('RATES_HOST_CONCURRENCY', str(RATES_FETCH_CONCURRENCY)))
+# Consecutive failed requests opening the circuit to a host, and seconds it stays open
+RATES_BREAKER_THRESHOLD = int(os.environ.get('RATES_BREAKER_THRESHOLD', '10'))
+RATES_BREAKER_COOLDOWN = float(os.environ.get('RATES_BREAKER_COOLDOWN', '60'))
+# (connect, read) timeouts in seconds for every rates page request
+RATES_HTTP_TIMEOUT = (float(os.environ.get('RATES_HTTP_CONNECT_TIMEOUT', '10')),
+                      float(os.environ.get('RATES_HTTP_READ_TIMEOUT', '60')))
+
+class ThreadLocalProxy:
+    """Forward attribute access to the object the current thread bound under a name"""
+
+    def __init__(self, local, name):
+        self._local = local
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(getattr(self._local, self._name), attr)
+
+# Every pipeline worker thread holds its own connection and cursor
+db = threading.local()
+connection = ThreadLocalProxy(db, 'connection')
+pgcur = ThreadLocalProxy(db, 'cursor')
 
 def connect_to_db():
-    """Connect to the database"""
+    """Connect the current thread to the database"""
 
-    global connection, pgcur
-    connection = psycopg2.connect(host="db1",
+    db.connection = psycopg2.connect(host=os.environ.get('POSTGRES_HOST', 'db1'),
                                   database = os.environ['POSTGRES_DB'],
                                   user = os.environ['POSTGRES_USER'],
                                   password = os.environ['POSTGRES_PASSWORD'])
-    pgcur = connection.cursor()
-    connection.autocommit = True
-    if connection:
+    db.cursor = db.connection.cursor()
+    db.connection.autocommit = True
+    if db.connection:
         logging.debug('pg connected')
         pgcur.execute("SET TIME ZONE %s",(utc_timezone,))
         pgcur.execute("SHOW TIMEZONE")
@@ -26,6 +135,669 @@ def connect_to_db():
         logging.critical('postgres unavailable, start the database to get going')
 
 
+def utc_now_text():
+    """Return the current UTC time in the text form of a TIMESTAMP column"""
+
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')
+
+def copy_text_value(value):
+    """Render a value as a field of the COPY text format"""
+
+    if value is None:
+        return '\\N'
+    if not isinstance(value, str):
+        value = str(value)
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+                 .replace('\n', '\\n').replace('\r', '\\r'))
+
+class CopyStream:
+    """File-like object producing rows in the COPY text format as they are read"""
+
+    def __init__(self, rows):
+        self._lines = ('\t'.join(copy_text_value(value) for value in row) + '\n' for row in rows)
+        self._pending = ''
+
+    def read(self, size=-1):
+        chunks = [self._pending]
+        length = len(self._pending)
+        for line in self._lines:
+            chunks.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
+        data = ''.join(chunks)
+        if size < 0:
+            self._pending = ''
+            return data
+        self._pending = data[size:]
+        return data[:size]
+
+def copy_rows(table, columns, rows):
+    """Stream rows into the columns of a table with COPY FROM STDIN"""
+
+    query = "COPY %s (%s) FROM STDIN" % (table, ", ".join(columns))
+    pgcur.copy_expert(query, CopyStream(rows))
+    return pgcur.rowcount
+
+
+def create_shadow_schemas():
+    """Create the staging and retired schemas of the shadow load mode
+
+    Run once before the stages start, concurrent CREATE SCHEMA IF NOT EXISTS
+    statements can fail on the unique index of pg_namespace.
+    """
+
+    for schema in (STAGING_SCHEMA, RETIRED_SCHEMA):
+        try:
+            pgcur.execute("CREATE SCHEMA IF NOT EXISTS %s" % schema)
+            logging.info(f"Schema created : {schema}")
+        except psycopg2.Error as e:
+            logging.critical(f"Error in creating schema {schema}:{e}")
+
+def begin_shadow_load(table, resume=False):
+    """Create an empty staging copy of a table and resolve this connection's unqualified names to it
+
+    With resume an existing staging copy is kept to carry on an interrupted
+    load. Returns the live schema of the table and the search_path to restore.
+    """
+
+    pgcur.execute("SELECT current_schema()")
+    live_schema = pgcur.fetchone()[0]
+    pgcur.execute("SHOW search_path")
+    search_path = pgcur.fetchone()[0]
+    if not resume:
+        pgcur.execute("DROP TABLE IF EXISTS %s.%s" % (STAGING_SCHEMA, table))
+    pgcur.execute("CREATE TABLE IF NOT EXISTS %s.%s (LIKE %s.%s INCLUDING ALL)" % (STAGING_SCHEMA, table, live_schema, table))
+    pgcur.execute("SET search_path TO %s, %s" % (STAGING_SCHEMA, search_path))
+    logging.info(f"Loading table {table} through {STAGING_SCHEMA}.{table}")
+    return live_schema, search_path
+
+def finish_shadow_load(table, live_schema):
+    """Swap the loaded staging copy of a table into place in a single transaction
+
+    The SERIAL sequence and the index names of the live table are handed over
+    to the new table, so repeated swaps keep a stable schema. An empty staging
+    copy never replaces a populated table.
+    """
+
+    staged = "%s.%s" % (STAGING_SCHEMA, table)
+    live = "%s.%s" % (live_schema, table)
+    pgcur.execute("SELECT EXISTS (SELECT 1 FROM %s), EXISTS (SELECT 1 FROM %s)" % (staged, live))
+    staged_rows, live_rows = pgcur.fetchone()
+    if live_rows and not staged_rows:
+        pgcur.execute("DROP TABLE %s" % staged)
+        logging.critical(f"Load of {table} produced no rows, keeping the previous snapshot")
+        return False
+    pgcur.execute("""SELECT DISTINCT ON (staged.relname) staged.relname, live.relname
+                     FROM pg_index si
+                     JOIN pg_class staged ON staged.oid = si.indexrelid
+                     JOIN pg_index li ON li.indrelid = %s::regclass AND li.indisunique = si.indisunique
+                     JOIN pg_class live ON live.oid = li.indexrelid
+                     WHERE si.indrelid = %s::regclass
+                       AND split_part(pg_get_indexdef(si.indexrelid), ' USING ', 2)
+                           = split_part(pg_get_indexdef(li.indexrelid), ' USING ', 2)
+                       AND staged.relname <> live.relname""", (live, staged))
+    index_renames = pgcur.fetchall()
+    pgcur.execute("""SELECT pg_get_serial_sequence(%s, attname) FROM pg_attribute
+                     WHERE attrelid = %s::regclass AND attname = 'id' AND NOT attisdropped""", (live, live))
+    row = pgcur.fetchone()
+    sequence = row[0] if row else None
+
+    statements = []
+    if sequence:
+        # owned sequences move and drop with their table, detach it first
+        statements.append("ALTER SEQUENCE %s OWNED BY NONE" % sequence)
+    statements += ["ALTER TABLE %s SET SCHEMA %s" % (live, RETIRED_SCHEMA),
+                   "ALTER TABLE %s SET SCHEMA %s" % (staged, live_schema)]
+    statements += ["ALTER INDEX %s.%s RENAME TO %s" % (live_schema, staged_index, live_index)
+                   for staged_index, live_index in index_renames]
+    if sequence:
+        statements.append("ALTER SEQUENCE %s OWNED BY %s.id" % (sequence, live))
+    statements.append("DROP TABLE %s.%s" % (RETIRED_SCHEMA, table))
+    try:
+        pgcur.execute("BEGIN")
+        for statement in statements:
+            pgcur.execute(statement)
+        pgcur.execute("COMMIT")
+        logging.info(f"Swapped the new snapshot into table {table}")
+        return True
+    except psycopg2.Error as e:
+        pgcur.execute("ROLLBACK")
+        logging.critical(f"Error in swapping the new snapshot into table {table}, keeping the previous one:{e}")
+        return False
+
+class IncompleteLoad(Exception):
+    """A load stopped part way that the next run resumes from its checkpoint"""
+
+class RejectedRatesPages(Exception):
+    """Rates pages the database rejected during a crawl, which therefore restarts on the next run"""
+
+def staging_table_exists(table):
+    """Tell whether a staging copy of a table was left by an interrupted shadow load"""
+
+    pgcur.execute("SELECT to_regclass(%s) IS NOT NULL", ("%s.%s" % (STAGING_SCHEMA, table),))
+    return pgcur.fetchone()[0]
+
+@contextmanager
+def table_load(table, truncate, resume=False):
+    """Wrap the refill of a table, truncating it first or loading it through a staging copy
+
+    With resume the rows already loaded by an interrupted load are kept, and
+    an IncompleteLoad keeps them for the next attempt instead of dropping them.
+    Yields a dict whose 'replaced' tells, once the block is done, whether the
+    loaded rows are now the table, False when a shadow swap was refused.
+    """
+
+    load = {'replaced': False}
+    if TABLE_LOAD_MODE != 'shadow':
+        if not resume:
+            truncate()
+        yield load
+        load['replaced'] = True
+        analyze_table(table)
+        return
+    live_schema, search_path = begin_shadow_load(table, resume)
+    try:
+        yield load
+    except BaseException as e:
+        pgcur.execute("SET search_path TO %s" % search_path)
+        if not isinstance(e, IncompleteLoad):
+            pgcur.execute("DROP TABLE IF EXISTS %s.%s" % (STAGING_SCHEMA, table))
+        raise
+    pgcur.execute("SET search_path TO %s" % search_path)
+    load['replaced'] = finish_shadow_load(table, live_schema)
+    analyze_table(table)
+
+# Secondary indexes created along with each table, by table
+MANAGED_INDEXES = {
+    'azure_rates': (('azure_rates_sku_region_type', 'arm_sku_name, arm_region_name, type'),),
+    'virtualMachines': (('virtualmachines_name_locations', 'name, locations'),),
+}
+
+def create_managed_indexes(table):
+    """Create the secondary indexes of a table listed in MANAGED_INDEXES"""
+
+    for index, columns in MANAGED_INDEXES.get(table, ()):
+        try:
+            pgcur.execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (index, table, columns))
+            logging.info(f"Index created : {index}")
+        except psycopg2.Error as e:
+            logging.error(f"Error in creating index {index}:{e}")
+
+def analyze_table(table):
+    """Refresh the planner statistics of a table after a bulk load"""
+
+    try:
+        pgcur.execute("ANALYZE %s" % table)
+        logging.info(f"Analyzed table : {table}")
+    except psycopg2.Error as e:
+        logging.error(f"Error in analyzing table {table}:{e}")
+
+
+# Metrics of the stages of the current run, by stage name
+run_metrics = {}
+run_metrics_lock = threading.Lock()
+# Name of the stage the current thread runs
+stage_context = threading.local()
+
+def reset_run_metrics():
+    """Forget the metrics of the previous run"""
+
+    with run_metrics_lock:
+        run_metrics.clear()
+
+def record_stage_metrics(step=None, **amounts):
+    """Add amounts such as seconds, rows, payload_bytes or retries to the current stage and one of its steps"""
+
+    stage = getattr(stage_context, 'name', None)
+    if stage is None:
+        return
+    with run_metrics_lock:
+        metrics = run_metrics.setdefault(stage, {'seconds': 0.0, 'rows': 0, 'payload_bytes': 0, 'retries': 0, 'steps': {}})
+        if step is not None:
+            step_metrics = metrics['steps'].setdefault(step, {'calls': 0, 'seconds': 0.0})
+            step_metrics['calls'] += 1
+            for key, amount in amounts.items():
+                step_metrics[key] = step_metrics.get(key, 0) + amount
+            # the time of a step is already part of the wall time of its stage
+            amounts.pop('seconds', None)
+        for key, amount in amounts.items():
+            metrics[key] = metrics.get(key, 0) + amount
+
+if prometheus_client is not None:
+    STAGE_SECONDS = prometheus_client.Gauge('vmsamp_stage_duration_seconds', 'Wall time of the last run of a stage', ['stage'])
+    STAGE_ROWS = prometheus_client.Gauge('vmsamp_stage_rows', 'Rows loaded by the last run of a stage', ['stage'])
+    STAGE_FAILED = prometheus_client.Gauge('vmsamp_stage_failed', 'Whether the last run of a stage failed', ['stage'])
+    RATES_PAGES = prometheus_client.Counter('vmsamp_rates_pages_fetched', 'Rates pages fetched from the prices API')
+    RATES_HTTP_SECONDS = prometheus_client.Histogram('vmsamp_rates_http_request_seconds', 'Latency of rates page requests',
+                                                     buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60))
+    DB_STATEMENT_SECONDS = prometheus_client.Histogram('vmsamp_db_statement_seconds', 'Latency of the insert steps', ['step'],
+                                                       buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300))
+    RUN_SECONDS = prometheus_client.Gauge('vmsamp_run_duration_seconds', 'Wall time of the last pipeline run')
+    LAST_SUCCESS = prometheus_client.Gauge('vmsamp_last_success_timestamp_seconds', 'Unix time the last run without failed stages finished')
+
+def export_run_metrics(summary):
+    """Publish the summary of a finished run on the metrics endpoint"""
+
+    if prometheus_client is None:
+        return
+    for stage, metrics in summary['stages'].items():
+        STAGE_SECONDS.labels(stage).set(metrics['seconds'])
+        STAGE_ROWS.labels(stage).set(metrics['rows'])
+    for stage in summary['done']:
+        STAGE_FAILED.labels(stage).set(0)
+    for stage in summary['failed']:
+        STAGE_FAILED.labels(stage).set(1)
+    RUN_SECONDS.set(summary['seconds'])
+    if not summary['failed']:
+        LAST_SUCCESS.set_to_current_time()
+
+def start_metrics_server(port=None):
+    """Serve the Prometheus metrics endpoint from a background thread when METRICS_PORT is set"""
+
+    port = port or METRICS_PORT
+    if not port:
+        return
+    if prometheus_client is None:
+        logging.warning("METRICS_PORT is set but prometheus_client is not installed, serving no metrics")
+        return
+    prometheus_client.start_http_server(int(port))
+    logging.info(f"Serving metrics on port {port}")
+
+def measured(kind):
+    """Decorate a fetch or insert step to record its wall time and payload bytes or affected rows
+
+    Fetch steps count the length of the JSON text they return, insert steps
+    the rowcount of their last statement.
+    """
+
+    def decorate(step):
+        @functools.wraps(step)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            result = step(*args, **kwargs)
+            amounts = {'seconds': time.perf_counter() - started}
+            if kind == 'fetch':
+                amounts['payload_bytes'] = len(result) if isinstance(result, (str, bytes)) else 0
+            else:
+                amounts['rows'] = max(pgcur.rowcount, 0)
+                if prometheus_client is not None:
+                    DB_STATEMENT_SECONDS.labels(step.__name__).observe(amounts['seconds'])
+            record_stage_metrics(step.__name__, **amounts)
+            return result
+        return wrapper
+    return decorate
+
+def create_table_pipeline_runs():
+    """Create table pipeline_runs storing the metrics summary of every run"""
+
+    query = """
+        CREATE TABLE IF NOT EXISTS pipeline_runs(
+                    id SERIAL PRIMARY KEY,
+                    started_at TIMESTAMP,
+                    finished_at TIMESTAMP,
+                    seconds NUMERIC,
+                    stages_done INT,
+                    stages_failed INT,
+                    summary JSONB)
+            """
+    try:
+        pgcur.execute(query)
+        logging.info("Table Created: pipeline_runs")
+    except psycopg2.Error as e:
+        logging.error(f"Error creating table pipeline_runs:{e}")
+
+def insert_into_pipeline_runs(summary):
+    """Store the metrics summary of a run in pipeline_runs"""
+
+    query = """INSERT INTO pipeline_runs (started_at, finished_at, seconds, stages_done, stages_failed, summary)
+               VALUES (%s, %s, %s, %s, %s, %s)"""
+    try:
+        pgcur.execute(query, (summary['started_at'], summary['finished_at'], summary['seconds'],
+                              len(summary['done']), len(summary['failed']), json.dumps(summary)))
+        logging.info("Data inserted into pipeline_runs table")
+    except psycopg2.Error as e:
+        logging.error(f"Error in inserting data into pipeline_runs table:{e}")
+
+
+resource_skus_lock = threading.Lock()
+resource_skus_by_type = None
+
+sku_cache_lock = threading.Lock()
+sku_cache_stats = {'hits': 0, 'misses': 0, 'unchanged': 0}
+sku_source = None
+
+def get_sku_source():
+    """Return the resource_skus source selected by SKU_SOURCE"""
+
+    global sku_source
+    with sku_cache_lock:
+        if sku_source is None:
+            if SKU_SOURCE == 'file':
+                sku_source = skusources.FileSkuSource(SKU_SOURCE_FILE)
+            elif SKU_SOURCE == 'synthetic':
+                sku_source = skusources.SyntheticSkuSource(SKU_SYNTHETIC_REGIONS, SKU_SYNTHETIC_SKUS)
+            elif SKU_SOURCE == 'stackql':
+                sku_source = skusources.StackQLSkuSource(stackql, subscription_id)
+            else:
+                raise ValueError(f"Unknown SKU_SOURCE {SKU_SOURCE!r}, expected one of {', '.join(SKU_SOURCES)}")
+    return sku_source
+
+def sku_cache_path(resource_type):
+    """Return the cache file of the resource_skus of a subscription and resource type"""
+
+    key = (resource_type or 'all').replace('/', '_')
+    return os.path.join(SKU_CACHE_DIR, f"resource_skus-{subscription_id}-{key}.json.gz")
+
+def reset_sku_cache_stats():
+    """Forget the cache hits, misses and unchanged refetches of the previous run"""
+
+    with sku_cache_lock:
+        for outcome in sku_cache_stats:
+            sku_cache_stats[outcome] = 0
+
+def count_sku_cache(outcome):
+    """Count a cache hit, miss or unchanged refetch"""
+
+    with sku_cache_lock:
+        sku_cache_stats[outcome] += 1
+
+def read_sku_cache(path):
+    """Return the cached records if the cache file is younger than the TTL"""
+
+    try:
+        if time.time() - os.path.getmtime(path) > SKU_CACHE_TTL:
+            return None
+        with gzip.open(path, 'rt', encoding='utf-8') as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError) as e:
+        if not isinstance(e, FileNotFoundError):
+            logging.warning(f"Ignoring unreadable resource_skus cache {path}:{e}")
+        return None
+
+def write_sku_cache(path, records):
+    """Store records in the cache, only touching the file when its content tag is unchanged"""
+
+    payload = json.dumps(records, sort_keys=True).encode('utf-8')
+    etag = hashlib.sha256(payload).hexdigest()
+    etag_path = path + '.etag'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path) and os.path.exists(etag_path):
+            with open(etag_path) as etag_file:
+                if etag_file.read().strip() == etag:
+                    os.utime(path)
+                    count_sku_cache('unchanged')
+                    logging.debug(f"resource_skus unchanged since last fetch, refreshed {path}")
+                    return
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, 'wb', compresslevel=6) as cache_file:
+            cache_file.write(payload)
+        os.replace(tmp_path, path)
+        with open(etag_path, 'w') as etag_file:
+            etag_file.write(etag)
+    except OSError as e:
+        logging.warning(f"Error in writing resource_skus cache {path}:{e}")
+
+def fetch_data_resource_skus(resource_type=None, bypass_cache=None):
+    """Fetch resource_skus from the SKU source, for one resource type or for all of them
+
+    StackQL results are served from the on-disk cache while it is fresh;
+    bypassing the cache always queries StackQL but still refreshes the cache.
+    """
+
+    source = get_sku_source()
+    if not source.cacheable:
+        return source.fetch(resource_type)
+    if bypass_cache is None:
+        bypass_cache = SKU_CACHE_BYPASS
+    path = sku_cache_path(resource_type)
+    if not bypass_cache:
+        records = read_sku_cache(path)
+        if records is not None:
+            count_sku_cache('hits')
+            logging.info(f"Read resource_skus {resource_type or 'all'} from cache {path}")
+            return records
+    count_sku_cache('misses')
+
+    records = source.fetch(resource_type)
+    # pystackql reports failures as a single error record, never cache those
+    if not (len(records) == 1 and 'error' in records[0]):
+        write_sku_cache(path, records)
+    return records
+
+def reset_resource_skus():
+    """Forget the resource_skus partitions of the previous run"""
+
+    global resource_skus_by_type
+    with resource_skus_lock:
+        resource_skus_by_type = None
+
+class ResourceSkusUnavailable(Exception):
+    """The SKU source returned an error or no resource_skus records at all"""
+
+def checked_resource_skus(records, resource_type=None):
+    """Return the records, raising ResourceSkusUnavailable on a pystackql error record or an empty result
+
+    Loading such a result would empty the resource_skus tables and vm_pricing.
+    """
+
+    if records and len(records) == 1 and 'error' in records[0]:
+        raise ResourceSkusUnavailable(f"resource_skus {resource_type or 'all'} query failed: {records[0]['error']}")
+    if not records:
+        raise ResourceSkusUnavailable(f"resource_skus {resource_type or 'all'} query returned no records")
+    return records
+
+def fetch_resource_skus_partition(resource_type):
+    """Return the resource_skus records of one resource type
+
+    In the combined fetch mode the first caller of a run queries every
+    resource type at once and partitions the records by resourceType, the
+    other stages then read their partition from memory. A failed or empty
+    query raises ResourceSkusUnavailable so the stages fail instead of loading nothing.
+    """
+
+    global resource_skus_by_type
+    if SKU_FETCH_MODE != 'combined':
+        return checked_resource_skus(fetch_data_resource_skus(resource_type), resource_type)
+    with resource_skus_lock:
+        if resource_skus_by_type is None:
+            partitions = {}
+            for record in checked_resource_skus(fetch_data_resource_skus()):
+                partitions.setdefault(record.get('resourceType'), []).append(record)
+            resource_skus_by_type = partitions
+            logging.info("Fetched resource_skus from StackQL: %s",
+                         {rtype: len(records) for rtype, records in partitions.items()})
+        return resource_skus_by_type.get(resource_type, [])
+
+
+# Capability columns of the resource_skus tables with their column types
+AVAILABILITYSET_CAPABILITIES = [('MaximumPlatformFaultDomainCount', 'INT')]
+DISK_CAPABILITIES = [
+    ('MinIopsPerGiBReadOnly', 'INT'), ('MaxIOpsReadWrite', 'INT'), ('MaxZonalFaultDomainCount', 'INT'),
+    ('BurstCreditBucketSizeInIO', 'INT'), ('MaxBurstBandwidthMBps', 'INT'), ('MaxSizeGiB', 'INT'),
+    ('MaxIopsPerGiBReadWrite', 'INT'), ('MinIopsReadOnly', 'INT'), ('MaxIOps', 'INT'),
+    ('MinIOpsReadWrite', 'INT'), ('MinBandwidthMBps', 'INT'), ('MaxBandwidthMBpsReadOnly', 'INT'),
+    ('MinIopsPerGiBReadWrite', 'INT'), ('MinIOSizeKiBps', 'INT'), ('MaxBandwidthMBpsPerformancePlus', 'INT'),
+    ('MinBandwidthMBpsReadOnly', 'INT'), ('MaxValueOfMaxShares', 'INT'), ('MaxBurstDurationInMin', 'INT'),
+    ('BurstCreditBucketSizeInGiB', 'INT'), ('MinBandwidthMBpsReadWrite', 'INT'), ('MaxBandwidthMBpsReadWrite', 'INT'),
+    ('PlatformFaultDomainCount', 'INT'), ('MinIOps', 'INT'), ('MaxIOpsPerformancePlus', 'INT'),
+    ('BillingPartitionSizes', 'TEXT'), ('MaxBurstIops', 'INT'), ('MinSizeGiB', 'INT'),
+    ('MaxIopsPerGiBReadOnly', 'INT'), ('MaxBandwidthMBps', 'INT'), ('MaxIOSizeKiBps', 'INT'),
+    ('MaxIopsReadOnly', 'INT'),
+]
+HOSTGROUP_CAPABILITIES = [('Cores', 'INT'), ('vCPUsPerCore', 'INT'), ('vCPUs', 'INT'), ('SupportsAutoplacement', 'BOOLEAN')]
+VM_CAPABILITIES = [
+    ('LowPriorityCapable', 'BOOLEAN'), ('MemoryGB', 'NUMERIC'), ('vCPUsAvailable', 'INTEGER'),
+    ('CapacityReservationSupported', 'BOOLEAN'), ('CachedDiskBytes', 'NUMERIC'), ('HyperVGenerations', 'TEXT'),
+    ('vCPUsPerCore', 'INTEGER'), ('MaxDataDiskCount', 'INTEGER'), ('RdmaEnabled', 'BOOLEAN'),
+    ('CombinedTempDiskAndCachedIOPS', 'INTEGER'), ('UltraSSDAvailable', 'BOOLEAN'), ('VMDeploymentTypes', 'TEXT'),
+    ('CombinedTempDiskAndCachedReadBytesPerSecond', 'NUMERIC'), ('RetirementDateUtc', 'DATE'),
+    ('OSVhdSizeMB', 'INTEGER'), ('MaxResourceVolumeMB', 'INTEGER'), ('TrustedLaunchDisabled', 'BOOLEAN'),
+    ('MaxWriteAcceleratorDisksAllowed', 'INTEGER'), ('ParentSize', 'TEXT'), ('NvmeSizePerDiskInMiB', 'INTEGER'),
+    ('NvmeDiskSizeInMiB', 'INTEGER'), ('CpuArchitectureType', 'TEXT'), ('UncachedDiskIOPS', 'INTEGER'),
+    ('vCPUs', 'INTEGER'), ('PremiumIO', 'BOOLEAN'), ('SupportedEphemeralOSDiskPlacements', 'TEXT'),
+    ('ConfidentialComputingType', 'TEXT'), ('DiskControllerTypes', 'TEXT'), ('ACUs', 'INTEGER'),
+    ('MemoryPreservingMaintenanceSupported', 'BOOLEAN'), ('EncryptionAtHostSupported', 'BOOLEAN'),
+    ('MaxNetworkInterfaces', 'INTEGER'), ('HibernationSupported', 'BOOLEAN'),
+    ('UncachedDiskBytesPerSecond', 'NUMERIC'), ('EphemeralOSDiskSupported', 'BOOLEAN'), ('GPUs', 'INTEGER'),
+    ('AcceleratedNetworkingEnabled', 'BOOLEAN'), ('CombinedTempDiskAndCachedWriteBytesPerSecond', 'NUMERIC'),
+]
+
+# resourceType -> (table, capability columns, location info column); snapshots
+# keep the raw capabilities text instead of capability columns
+SKU_TABLE_LAYOUTS = {
+    'availabilitySets': ('availabilitySets', AVAILABILITYSET_CAPABILITIES, 'locationsInfo'),
+    'snapshots': ('snapshots', None, 'locationInfo'),
+    'disks': ('disks', DISK_CAPABILITIES, 'locationInfo'),
+    'hostGroups/hosts': ('hostGroups_hosts', HOSTGROUP_CAPABILITIES, 'locationInfo'),
+    'virtualMachines': ('virtualMachines', VM_CAPABILITIES, 'locationInfo'),
+}
+
+def sku_text(item, key):
+    """Return a resource_skus field as text, mapping JSON and literal nulls to None"""
+
+    value = item.get(key)
+    if value is None or value == 'null':
+        return None
+    return value if isinstance(value, str) else json.dumps(value)
+
+def sku_json(value):
+    """Parse a resource_skus field that StackQL returns as JSON text"""
+
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return None
+    return value
+
+def sku_capabilities(item):
+    """Map the capability names of a resource_skus record to their values, the first one of a repeated name"""
+
+    capabilities = sku_json(item.get('capabilities'))
+    if not isinstance(capabilities, list):
+        return {}
+    values = {}
+    for capability in capabilities:
+        value = capability.get('value')
+        values.setdefault(capability.get('name'), None if value == 'null' else value)
+    return values
+
+def sku_table_columns(resource_type):
+    """Return the columns of the table of a resource type in load order"""
+
+    table, capabilities, location_info_column = SKU_TABLE_LAYOUTS[resource_type]
+    if capabilities is None:
+        middle = ['capabilities']
+    else:
+        middle = [name for name, _ in capabilities]
+    return (['apiVersions'] + middle +
+            ['capacity', 'costs', 'family', 'kind', location_info_column, 'locations',
+             'name', 'resourceType', 'restrictions', 'size', 'tier', 'run_timestamp'])
+
+def flatten_sku_record(resource_type, item, run_timestamp):
+    """Flatten a resource_skus record into a row of its table in COPY text form"""
+
+    _, capabilities, _ = SKU_TABLE_LAYOUTS[resource_type]
+    if capabilities is None:
+        middle = [sku_text(item, 'capabilities')]
+    else:
+        values = sku_capabilities(item)
+        middle = [values.get(name) for name, _ in capabilities]
+    if resource_type == 'virtualMachines':
+        # the virtual machine SKUs are listed per location
+        locations = sku_json(item.get('locations'))
+        location = locations[0] if isinstance(locations, list) and locations else None
+    else:
+        location = sku_text(item, 'locations')
+    restrictions = item.get('restrictions')
+    return ([sku_text(item, 'apiVersions')] + middle +
+            [sku_text(item, 'capacity'),
+             sku_text(item, 'costs'),
+             sku_text(item, 'family'),
+             sku_text(item, 'kind'),
+             json.dumps(item['locationInfo']) if 'locationInfo' in item else None,
+             location,
+             sku_text(item, 'name'),
+             sku_text(item, 'resourceType'),
+             None if restrictions is None or restrictions == '[]' else json.dumps(restrictions),
+             sku_text(item, 'size'),
+             sku_text(item, 'tier'),
+             run_timestamp])
+
+def sku_pivot_insert_query(resource_type):
+    """Build the INSERT ... SELECT of a resource type that pivots its capabilities in one pass
+
+    The capabilities array of each SKU is parsed once and folded into a single
+    jsonb object by a lateral jsonb_object_agg, every capability column is then
+    a key lookup on that object instead of a scan of the array. The array is
+    folded last to first so a repeated capability keeps its first value, as
+    sku_capabilities() does on the COPY path.
+    """
+
+    table, capabilities, location_info_column = SKU_TABLE_LAYOUTS[resource_type]
+    if resource_type == 'virtualMachines':
+        # the virtual machine SKUs are listed per location
+        locations = "(SELECT jsonb_array_elements_text((item->>'locations')::jsonb))"
+    else:
+        locations = "NULLIF(item->>'locations', 'null')"
+    expressions = (["NULLIF(item->>'apiVersions', 'null')"] +
+                   ["NULLIF(caps->>'%s', 'null')::%s" % (name, column_type)
+                    for name, column_type in capabilities] +
+                   ["NULLIF(item->>'capacity', 'null')",
+                    "NULLIF(item->>'costs', 'null')",
+                    "NULLIF(item->>'family', 'null')",
+                    "NULLIF(item->>'kind', 'null')",
+                    "item->'locationInfo'",
+                    locations,
+                    "NULLIF(item->>'name', 'null')",
+                    "NULLIF(item->>'resourceType', 'null')",
+                    "(CASE WHEN item->'restrictions' = '\"[]\"' THEN NULL ELSE item->'restrictions' END)",
+                    "NULLIF(item->>'size', 'null')",
+                    "NULLIF(item->>'tier', 'null')",
+                    "CURRENT_TIMESTAMP"])
+    columns = sku_table_columns(resource_type)
+    select_list = ",\n                ".join("%s AS %s" % (expression, column)
+                                         for expression, column in zip(expressions, columns))
+    return """
+            WITH split_data AS (
+                SELECT jsonb_array_elements(%%s::jsonb) AS item
+            ),
+            pivot AS (
+                SELECT item, capabilities.caps
+                FROM split_data
+                CROSS JOIN LATERAL (SELECT (item->>'capabilities')::jsonb AS arr) AS parsed
+                CROSS JOIN LATERAL (
+                    SELECT jsonb_object_agg(elem->>'name', elem->>'value' ORDER BY position DESC) AS caps
+                    FROM jsonb_array_elements(
+                        CASE WHEN jsonb_typeof(parsed.arr) = 'array' THEN parsed.arr ELSE '[]'::jsonb END
+                    ) WITH ORDINALITY AS elements(elem, position)
+                    WHERE elem->>'name' IS NOT NULL
+                ) AS capabilities
+            )
+            INSERT INTO %s (
+                %s
+            )
+            SELECT
+                %s
+            FROM pivot;
+            """ % (table, ",\n                ".join(columns), select_list)
+
+def copy_into_sku_table(resource_type, data):
+    """Bulk load resource_skus records of one resource type with COPY"""
+
+    table = SKU_TABLE_LAYOUTS[resource_type][0]
+    records = json.loads(data) if isinstance(data, str) else data
+    run_timestamp = utc_now_text()
+    try:
+        copy_rows(table, sku_table_columns(resource_type),
+                  (flatten_sku_record(resource_type, item, run_timestamp) for item in records))
+        logging.info(f"Data copied into the table {table}")
+    except (psycopg2.Error, ValueError) as e:
+        logging.error(f"Error in copying data into the {table} table:{e}")
+
+
 def create_table_availabilitysets():
     """Create table for the resource type availability sets"""
 
@@ -60,14 +832,12 @@ def truncate_table_availabilitysets():
     except psycopg2.Error as e:
         logging.critical(f"Error in truncating availabilitysets table:{e}")
 
+@measured('fetch')
 def fetch_data_availabilitysets():
     """Fetch the data of the availability sets using StackQL"""
 
     try:
-        query = """select * from azure.compute.resource_skus
-               where subscriptionId = '%s' and resourceType = 'availabilitySets'
-                ;""" % (subscription_id)
-        res = stackql.execute(query)
+        res = fetch_resource_skus_partition('availabilitySets')
         json_data = json.dumps(res)
         logging.info("Fetched the availabilitysets data from StackQL")
         return json_data
@@ -75,98 +845,13 @@ def fetch_data_availabilitysets():
         logging.error(f"Error in Fetching availability sets data from StackQL:{e}")
 
 
+@measured('insert')
 def insert_into_availabilitysets(a_data):
     """Insert data into availabilitySets"""
 
-    query = """
-                WITH split_data AS (
-                    SELECT jsonb_array_elements(%s::jsonb) AS item 
-                )
-                INSERT INTO availabilitySets (
-                    apiVersions,
-                    maximumPlatformFaultDomainCount,
-                    capacity,
-                    costs,
-                    family,
-                    kind,
-                    locationsInfo,
-                    locations,
-                    name,
-                    resourceType,
-                    restrictions,
-                    size,
-                    tier,
-                    run_timestamp
-                )
-                SELECT 
-                    (CASE
-                        WHEN item->>'apiVersions' = 'null' THEN NULL
-                        ELSE item->>'apiVersions'
-                    END) AS api_versions,
-                    (
-                        SELECT 
-                            (CASE
-                                WHEN elem->>'value' = 'null' THEN NULL
-                                ELSE (elem->>'value')::INT
-                            END)
-                        FROM jsonb_array_elements(
-                            CASE 
-                                WHEN jsonb_typeof((item->>'capabilities')::jsonb) = 'array'
-                                THEN (item->>'capabilities')::jsonb 
-                                ELSE '[]'::jsonb 
-                            END
-                        ) AS elem
-                        WHERE elem->>'name' = 'MaximumPlatformFaultDomainCount'
-                    ) AS maximum_platform_fault_domain_count,
-                    (CASE
-                        WHEN item->>'capacity' = 'null' THEN NULL
-                        ELSE item->>'capacity'
-                    END) AS capacity,
-                    (CASE
-                        WHEN item->>'costs' = 'null' THEN NULL
-                        ELSE item->>'costs'
-                    END) AS costs,
-                    (CASE
-                        WHEN item->>'family' = 'null' THEN NULL
-                        ELSE item->>'family'
-                    END) AS family,
-                    (CASE
-                        WHEN item->>'kind' = 'null' THEN NULL
-                        ELSE item->>'kind'
-                    END) AS kind,
-                    (CASE
-                        WHEN item->'locationInfo' IS NULL THEN NULL
-                        ELSE item->'locationInfo'
-                    END) AS location_info,
-                    (CASE
-                        WHEN item->>'locations' = 'null' THEN NULL
-                        ELSE item->>'locations'
-                    END) AS locations,
-                    (CASE
-                        WHEN item->>'name' = 'null' THEN NULL
-                        ELSE item->>'name'
-                    END) AS name,
-                    (CASE
-                        WHEN item->>'resourceType' = 'null' THEN NULL
-                        ELSE item->>'resourceType'
-                    END) AS resource_type,
-                    (CASE
-                        WHEN item->'restrictions' = '"[]"' THEN NULL
-                        ELSE item->'restrictions'
-                    END) AS restrictions,
-                    (CASE
-                        WHEN item->>'size' = 'null' THEN NULL
-                        ELSE item->>'size'
-                    END) AS size,
-                    (CASE
-                        WHEN item->>'tier' = 'null' THEN NULL
-                        ELSE item->>'tier'
-                    END) AS tier,
-                    CURRENT_TIMESTAMP AS run_timestamp
-                FROM split_data;
-
-
-        """
+    if LOAD_METHOD == 'copy':
+        return copy_into_sku_table('availabilitySets', a_data)
+    query = sku_pivot_insert_query('availabilitySets')
     try:
         pgcur.execute(query,(a_data,))
         logging.info("Data inserted into the table availabiltysets")
@@ -208,23 +893,24 @@ def truncate_table_snapshots():
         logging.critical(f"Error in truncating the table snapshots:{e}")
 
         
+@measured('fetch')
 def fetch_data_snapshots():
     """Fetch the data of the snapshots using StackQL"""
     
     try:
-        query = """select * from azure.compute.resource_skus
-                where subscriptionId = '%s' and resourceType = 'snapshots'
-                    ;""" % (subscription_id)
-        res = stackql.execute(query)
+        res = fetch_resource_skus_partition('snapshots')
         json_data_str = json.dumps(res)
         logging.info("Fetched Snapshots data from StackQL")
         return json_data_str
     except psycopg2.Error as e:
         logging.error(f"Error in Fetching snapshots data from StackQL:{e}")
 
+@measured('insert')
 def insert_into_snapshots(s_data):
     """Insert data into Snapshots table"""
 
+    if LOAD_METHOD == 'copy':
+        return copy_into_sku_table('snapshots', s_data)
     query = """
             WITH split_data AS (
                 SELECT jsonb_array_elements(%s::jsonb) AS item
@@ -370,13 +1056,11 @@ def truncate_table_disks():
     except psycopg2.Error as e:
         logging.Error(f"Error in truncating table disks:{e}")
 
+@measured('fetch')
 def fetch_data_disks():
     """Fetch the data of the disks using StackQL"""
     try:
-        query = """select * from azure.compute.resource_skus
-                where subscriptionId = '%s' and resourceType = 'disks'
-                    ;""" % (subscription_id)
-        res = stackql.execute(query)
+        res = fetch_resource_skus_partition('disks')
         json_data_str = json.dumps(res)
         logging.info("Fetched Disks data from StackQL")
         return json_data_str
@@ -384,474 +1068,13 @@ def fetch_data_disks():
     except psycopg2.Error as e:
         logging.error(f"Error in Fetching disks data from StackQL:{e}")
 
+@measured('insert')
 def insert_into_disks(d_data):
-    query = """
-            WITH split_data AS (
-                SELECT jsonb_array_elements(%s::jsonb) AS item
-            )
-            INSERT INTO disks (
-                apiVersions,
-                MinIopsPerGiBReadOnly,
-                MaxIOpsReadWrite,
-                MaxZonalFaultDomainCount,
-                BurstCreditBucketSizeInIO,
-                MaxBurstBandwidthMBps,
-                MaxSizeGiB,
-                MaxIopsPerGiBReadWrite,
-                MinIopsReadOnly,
-                MaxIOps,
-                MinIOpsReadWrite,
-                MinBandwidthMBps,
-                MaxBandwidthMBpsReadOnly,
-                MinIopsPerGiBReadWrite,
-                MinIOSizeKiBps,
-                MaxBandwidthMBpsPerformancePlus,
-                MinBandwidthMBpsReadOnly,
-                MaxValueOfMaxShares,
-                MaxBurstDurationInMin,
-                BurstCreditBucketSizeInGiB,
-                MinBandwidthMBpsReadWrite,
-                MaxBandwidthMBpsReadWrite,
-                PlatformFaultDomainCount,
-                MinIOps,
-                MaxIOpsPerformancePlus,
-                BillingPartitionSizes,
-                MaxBurstIops,
-                MinSizeGiB,
-                MaxIopsPerGiBReadOnly,
-                MaxBandwidthMBps,
-                MaxIOSizeKiBps,
-                MaxIopsReadOnly,
-                capacity,
-                costs,
-                family,
-                kind,
-                locationInfo,
-                locations,
-                name,
-                resourceType,
-                restrictions,
-                size,
-                tier,
-                run_timestamp
-            )
-            
-            SELECT 
-                (CASE
-                    WHEN item->>'apiVersions' = 'null' THEN NULL
-                    ELSE item->>'apiVersions'
-                END) AS api_versions,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MaxIopsPerGiBReadOnly'
-                ) AS MaxIopsPerGiBReadOnly,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MinIopsPerGiBReadOnly'
-                ) AS MinIopsPerGiBReadOnly,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MaxIOpsReadWrite'
-                ) AS MaxIOpsReadWrite,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MaxZonalFaultDomainCount'
-                ) AS MaxZonalFaultDomainCount,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'BurstCreditBucketSizeInIO'
-                ) AS BurstCreditBucketSizeInIO,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MaxBurstBandwidthMBps'
-                ) AS MaxBurstBandwidthMBps,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MaxSizeGiB'
-                ) AS MaxSizeGiB,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MaxIopsPerGiBReadWrite'
-                ) AS MaxIopsPerGiBReadWrite,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MinIopsReadOnly'
-                ) AS MinIopsReadOnly,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MaxIOps'
-                ) AS MaxIOps,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MinIOpsReadWrite'
-                ) AS MinIOpsReadWrite,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MinBandwidthMBps'
-                ) AS MinBandwidthMBps,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MaxBandwidthMBpsReadOnly'
-                ) AS MaxBandwidthMBpsReadOnly,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MinIopsPerGiBReadWrite'
-                ) AS MinIopsPerGiBReadWrite,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MaxBandwidthMBpsPerformancePlus'
-                ) AS MaxBandwidthMBpsPerformancePlus,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MinIOSizeKiBps'
-                ) AS MinIOSizeKiBps,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MinBandwidthMBpsReadOnly'
-                ) AS MinBandwidthMBpsReadOnly,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MaxBurstDurationInMin'
-                ) AS MaxBurstDurationInMin,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'BurstCreditBucketSizeInGiB'
-                ) AS BurstCreditBucketSizeInGiB,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MinBandwidthMBpsReadWrite'
-                ) AS MinBandwidthMBpsReadWrite,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MaxBandwidthMBpsReadWrite'
-                ) AS MaxBandwidthMBpsReadWrite,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'PlatformFaultDomainCount'
-                ) AS PlatformFaultDomainCount,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MinIOps'
-                ) AS MinIOps,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MaxIOpsPerformancePlus'
-                ) AS MaxIOpsPerformancePlus,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::text
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'BillingPartitionSizes'
-                ) AS BillingPartitionSizes,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MaxBurstIops'
-                ) AS MaxBurstIops,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MinSizeGiB'
-                ) AS MinSizeGiB,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MaxIopsPerGiBReadOnly'
-                ) AS MaxIopsPerGiBReadOnly,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MaxBandwidthMBps'
-                ) AS MaxBandwidthMBps,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MaxIOSizeKiBps'
-                ) AS MaxIOSizeKiBps,
-                (
-                    SELECT 
-                        (CASE
-                            WHEN elem->>'value' = 'null' THEN NULL
-                            ELSE (elem->>'value')::INT
-                        END)
-                    FROM jsonb_array_elements(
-                        (item->>'capabilities')::jsonb
-                    ) AS elem
-                    WHERE elem->>'name' = 'MaxIopsReadOnly'
-                ) AS MaxIopsReadOnly,
-                (
-                    CASE
-                        WHEN item->>'capacity' = 'null' THEN NULL
-                        ELSE item->>'capacity'
-                    END
-                ) AS capacity,
-                (
-                    CASE
-                        WHEN item->>'costs' = 'null' THEN NULL
-                        ELSE item->>'costs'
-                    END
-                ) AS costs,
-                (
-                    CASE
-                        WHEN item->>'family' = 'null' THEN NULL
-                        ELSE item->>'family'
-                    END
-                ) AS family,
-                (
-                    CASE
-                        WHEN item->>'kind' = 'null' THEN NULL
-                        ELSE item->>'kind'
-                    END
-                ) AS kind,
-                (
-                    CASE
-                        WHEN item->'locationInfo' IS NULL THEN NULL
-                        ELSE item->'locationInfo'
-                    END
-                ) AS location_info,
-                (
-                    CASE
-                        WHEN item->>'locations' = 'null' THEN NULL
-                        ELSE item->>'locations'
-                    END
-                ) AS locations,
-                (
-                    CASE
-                        WHEN item->>'name' = 'null' THEN NULL
-                        ELSE item->>'name'
-                    END
-                ) AS name,
-                (
-                    CASE
-                        WHEN item->>'resourceType' = 'null' THEN NULL
-                        ELSE item->>'resourceType'
-                    END
-                ) AS resource_type,
-                (
-                    CASE
-                        WHEN item->'restrictions' = '"[]"' THEN NULL
-                        ELSE item->'restrictions'
-                    END
-                ) AS restrictions,
-                (
-                    CASE
-                        WHEN item->>'size' = 'null' THEN NULL
-                        ELSE item->>'size'
-                    END
-                ) AS size,
-                (
-                    CASE
-                        WHEN item->>'tier' = 'null' THEN NULL
-                        ELSE item->>'tier'
-                    END
-                ) AS tier,
-                CURRENT_TIMESTAMP AS run_timestamp
-            FROM split_data;
+    """Insert data into the table disks"""
 
-        """
+    if LOAD_METHOD == 'copy':
+        return copy_into_sku_table('disks', d_data)
+    query = sku_pivot_insert_query('disks')
     try:
         pgcur.execute(query,(d_data,))
         logging.info("Data inserted into the table disks")
@@ -899,167 +1122,25 @@ def truncate_table_hostgroups():
     except psycopg2.Error as e:
         logging.critical(f"Error in truncating the table hostGroups_hosts:{e}")
 
+@measured('fetch')
 def fetch_data_hostgroups():
     """Fetch the data of the hostGroups/hosts using StackQL"""
         
     try:
-        query = """select * from azure.compute.resource_skus
-                where subscriptionId = '%s' and resourceType = 'hostGroups/hosts'
-                    ;""" % (subscription_id)
-        res = stackql.execute(query)
+        res = fetch_resource_skus_partition('hostGroups/hosts')
         json_data_str = json.dumps(res)
         logging.info("Fetched hostGroups/hosts data from StackQL")
         return json_data_str
     except psycopg2.Error as e:
         logging.critical("Error in Fetching hostgroups/hosts data from StackQL")
 
+@measured('insert')
 def insert_into_hostgroup(h_data):
     """Insert data into hostGroups_hosts table"""
 
-    query = """
-            WITH split_data AS (
-                            SELECT jsonb_array_elements(%s::jsonb) AS item 
-                        )
-                        INSERT INTO hostgroups_hosts (
-                            apiVersions,
-                            Cores ,
-                            vCPUsPerCore ,
-                            vCPUs ,
-                            SupportsAutoplacement ,
-                            capacity,
-                            costs,
-                            family,
-                            kind,
-                            locationInfo,
-                            locations,
-                            name,
-                            resourceType,
-                            restrictions,
-                            size,
-                            tier,
-                            run_timestamp
-                        )
-                        
-                        SELECT 
-                            (CASE
-                                WHEN item->>'apiVersions' = 'null' THEN NULL
-                                ELSE item->>'apiVersions'
-                            END) AS api_versions,
-                            (
-                                SELECT 
-                                    (CASE
-                                        WHEN elem->>'value' = 'null' THEN NULL
-                                        ELSE (elem->>'value')::INT
-                                    END)
-                                FROM jsonb_array_elements(
-                                    (item->>'capabilities')::jsonb
-                                ) AS elem
-                                WHERE elem->>'name' = 'Cores'
-                            ) AS Cores,
-                            (
-                                SELECT 
-                                    (CASE
-                                        WHEN elem->>'value' = 'null' THEN NULL
-                                        ELSE (elem->>'value')::INT
-                                    END)
-                                FROM jsonb_array_elements(
-                                    (item->>'capabilities')::jsonb
-                                ) AS elem
-                                WHERE elem->>'name' = 'vCPUsPerCore'
-                            ) AS vCPUsPerCore,
-                            (
-                                SELECT 
-                                    (CASE
-                                        WHEN elem->>'value' = 'null' THEN NULL
-                                        ELSE (elem->>'value')::INT
-                                    END)
-                                FROM jsonb_array_elements(
-                                    (item->>'capabilities')::jsonb
-                                ) AS elem
-                                WHERE elem->>'name' = 'vCPUs'
-                            ) AS vCPUs,
-                            (
-                                SELECT 
-                                    (CASE
-                                        WHEN elem->>'value' = 'null' THEN NULL
-                                        ELSE (elem->>'value')::boolean
-                                    END)
-                                FROM jsonb_array_elements(
-                                    (item->>'capabilities')::jsonb
-                                ) AS elem
-                                WHERE elem->>'name' = 'SupportsAutoplacement'
-                            ) AS SupportsAutoplacement,
-                        
-                            (
-                                CASE
-                                    WHEN item->>'capacity' = 'null' THEN NULL
-                                    ELSE item->>'capacity'
-                                END
-                            ) AS capacity,
-                            (
-                                CASE
-                                    WHEN item->>'costs' = 'null' THEN NULL
-                                    ELSE item->>'costs'
-                                END
-                            ) AS costs,
-                            (
-                                CASE
-                                    WHEN item->>'family' = 'null' THEN NULL
-                                    ELSE item->>'family'
-                                END
-                            ) AS family,
-                            (
-                                CASE
-                                    WHEN item->>'kind' = 'null' THEN NULL
-                                    ELSE item->>'kind'
-                                END
-                            ) AS kind,
-                            (
-                                CASE
-                                    WHEN item->'locationInfo' IS NULL THEN NULL
-                                    ELSE item->'locationInfo'
-                                END
-                            ) AS location_info,
-                            (
-                                CASE
-                                    WHEN item->>'locations' = 'null' THEN NULL
-                                    ELSE item->>'locations'
-                                END
-                            ) AS locations,
-                            (
-                                CASE
-                                    WHEN item->>'name' = 'null' THEN NULL
-                                    ELSE item->>'name'
-                                END
-                            ) AS name,
-                            (
-                                CASE
-                                    WHEN item->>'resourceType' = 'null' THEN NULL
-                                    ELSE item->>'resourceType'
-                                END
-                            ) AS resource_type,
-                            (
-                                CASE
-                                    WHEN item->'restrictions' = '"[]"' THEN NULL
-                                    ELSE item->'restrictions'
-                                END
-                            ) AS restrictions,
-                            (
-                                CASE
-                                    WHEN item->>'size' = 'null' THEN NULL
-                                    ELSE item->>'size'
-                                END
-                            ) AS size,
-                            (
-                                CASE
-                                    WHEN item->>'tier' = 'null' THEN NULL
-                                    ELSE item->>'tier'
-                                END
-                            ) AS tier,
-                            CURRENT_TIMESTAMP AS run_timestamp
-                        FROM split_data;
-
-            """
+    if LOAD_METHOD == 'copy':
+        return copy_into_sku_table('hostGroups/hosts', h_data)
+    query = sku_pivot_insert_query('hostGroups/hosts')
     try:
         pgcur.execute(query,(h_data,))
         logging.info("Data inserted into the table hostgroups_hosts")
@@ -1129,6 +1210,7 @@ def create_table_vms():
         logging.info("Table created : virtualMachines")
     except psycopg2.Error as e:
         logging.error(f"Error in creating table virtualMachines:{e}")
+    create_managed_indexes('virtualMachines')
 
 def truncate_table_vms():
     """Truncate the table virtualMachines"""
@@ -1139,527 +1221,25 @@ def truncate_table_vms():
     except psycopg2.Error as e:
         logging.Error(f"Error in truncating table virtualMachines:{e}")
 
+@measured('fetch')
 def fetch_data_vms():
     """Fetch the data of the virtual machines using StackQL"""
 
     try:
-        query = """select * from azure.compute.resource_skus
-               where subscriptionId = '%s' and resourceType = 'virtualMachines'
-                ;""" % (subscription_id)
-        res = stackql.execute(query)
+        res = fetch_resource_skus_partition('virtualMachines')
         json_data = json.dumps(res)
         logging.info("Fetched virtualmachines data from StackQL")
         return json_data
     except psycopg2.Error as e:
         logging.error(f"Error in fetching virtual machines data from StackQL:{e} ")
 
+@measured('insert')
 def insert_into_vms(v_data):
     """Insert data into the table virtualMachines"""
 
-    query ="""
-            WITH split_data AS (SELECT jsonb_array_elements(%s::jsonb) AS item )
-
-            INSERT INTO virtualMachines (
-                apiVersions,
-                LowPriorityCapable,
-                MemoryGB,
-                vCPUsAvailable,
-                CapacityReservationSupported,
-                CachedDiskBytes,
-                HyperVGenerations,
-                vCPUsPerCore,
-                MaxDataDiskCount,
-                RdmaEnabled,
-                CombinedTempDiskAndCachedIOPS,
-                UltraSSDAvailable,
-                VMDeploymentTypes,
-                CombinedTempDiskAndCachedReadBytesPerSecond,
-                RetirementDateUtc,
-                OSVhdSizeMB,
-                MaxResourceVolumeMB,
-                TrustedLaunchDisabled,
-                MaxWriteAcceleratorDisksAllowed,
-                ParentSize,
-                NvmeSizePerDiskInMiB,
-                NvmeDiskSizeInMiB,
-                CpuArchitectureType,
-                UncachedDiskIOPS,
-                vCPUs,
-                PremiumIO,
-                SupportedEphemeralOSDiskPlacements,
-                ConfidentialComputingType,
-                DiskControllerTypes,
-                ACUs,
-                MemoryPreservingMaintenanceSupported,
-                EncryptionAtHostSupported,
-                MaxNetworkInterfaces,
-                HibernationSupported,
-                UncachedDiskBytesPerSecond,
-                EphemeralOSDiskSupported,
-                GPUs,
-                AcceleratedNetworkingEnabled,
-                CombinedTempDiskAndCachedWriteBytesPerSecond,
-                capacity,
-                costs,
-                family,
-                kind,
-                locationInfo,
-                locations,
-                name,
-                resourceType,
-                restrictions,
-                size,
-                tier,
-                run_timestamp
-            )
-
-                        
-                        
-            SELECT 
-                (CASE
-                    WHEN item->>'apiVersions' = 'null' THEN NULL
-                    ELSE item->>'apiVersions'
-                END) AS api_versions,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::boolean
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) AS elem
-                WHERE elem->>'name' = 'LowPriorityCapable') 
-                AS LowPriorityCapable,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::NUMERIC
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb)
-                AS elem
-                WHERE elem->>'name' = 'MemoryGB') 
-                AS MemoryGB,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::INT
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) 
-                AS elem
-                WHERE elem->>'name' = 'vCPUsAvailable')
-                AS vCPUsAvailable,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::BOOLEAN
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) 
-                AS elem
-                WHERE elem->>'name' = 'CapacityReservationSupported') 
-                AS CapacityReservationSupported,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::NUMERIC
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) 
-                AS elem
-                WHERE elem->>'name' = 'CachedDiskBytes') 
-                AS CachedDiskBytes,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::TEXT
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) 
-                AS elem
-                WHERE elem->>'name' = 'HyperVGenerations') 
-                AS HyperVGenerations,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::INT
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) 
-                AS elem
-                WHERE elem->>'name' = 'vCPUsPerCore') 
-                AS vCPUsPerCore,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::INT
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) 
-                AS elem
-                WHERE elem->>'name' = 'MaxDataDiskCount') 
-                AS MaxDataDiskCount,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::BOOLEAN
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) 
-                AS elem
-                WHERE elem->>'name' = 'RdmaEnabled') 
-                AS RdmaEnabled,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::INT
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) 
-                AS elem
-                WHERE elem->>'name' = 'CombinedTempDiskAndCachedIOPS') 
-                AS CombinedTempDiskAndCachedIOPS,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::BOOLEAN
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) 
-                AS elem
-                WHERE elem->>'name' = 'UltraSSDAvailable') 
-                AS UltraSSDAvailable,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::TEXT
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) AS elem
-                WHERE elem->>'name' = 'VMDeploymentTypes') 
-                AS VMDeploymentTypes,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::NUMERIC
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) 
-                AS elem
-                WHERE elem->>'name' = 'CombinedTempDiskAndCachedReadBytesPerSecond') 
-                AS CombinedTempDiskAndCachedReadBytesPerSecond,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::DATE
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) 
-                AS elem
-                WHERE elem->>'name' = 'RetirementDateUtc'
-                ) AS RetirementDateUtc,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::INT
-                    END)
-                FROM jsonb_array_elements(
-                (item->>'capabilities')::jsonb) 
-                AS elem
-                WHERE elem->>'name' = 'OSVhdSizeMB') 
-                AS OSVhdSizeMB,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::INT
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) 
-                AS elem
-                WHERE elem->>'name' = 'MaxResourceVolumeMB') 
-                AS MaxResourceVolumeMB,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::BOOLEAN
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) 
-                AS elem
-                WHERE elem->>'name' = 'TrustedLaunchDisabled'
-                ) AS TrustedLaunchDisabled,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::INT
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) AS elem
-                WHERE elem->>'name' = 'MaxWriteAcceleratorDisksAllowed') 
-                AS MaxWriteAcceleratorDisksAllowed,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::TEXT
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) 
-                AS elem
-                WHERE elem->>'name' = 'ParentSize') 
-                AS ParentSize,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::INT
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) 
-                AS elem
-                WHERE elem->>'name' = 'NvmeSizePerDiskInMiB') 
-                AS  NvmeSizePerDiskInMiB,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::INT
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) 
-                AS elem
-                WHERE elem->>'name' = 'NvmeDiskSizeInMiB'
-                ) AS  NvmeDiskSizeInMiB,
-                (SELECT 
-                    (CASE
-                    WHEN elem->>'value' = 'null' THEN NULL
-                    ELSE (elem->>'value')::TEXT
-                    END)
-                FROM jsonb_array_elements((item->>'capabilities')::jsonb) 
-                AS elem
-                WHERE elem->>'name' = 'CpuArchitectureType') 
-                AS  CpuArchitectureType,
-                (
-                SELECT 
-                (CASE
-                WHEN elem->>'value' = 'null' THEN NULL
-                ELSE (elem->>'value')::INT
-                END)
-                FROM jsonb_array_elements(
-                (item->>'capabilities')::jsonb
-                ) AS elem
-                WHERE elem->>'name' = 'UncachedDiskIOPS'
-                ) AS  UncachedDiskIOPS,
-                (
-                SELECT 
-                (CASE
-                WHEN elem->>'value' = 'null' THEN NULL
-                ELSE (elem->>'value')::INT
-                END)
-                FROM jsonb_array_elements(
-                (item->>'capabilities')::jsonb
-                ) AS elem
-                WHERE elem->>'name' = 'vCPUs'
-                ) AS  vCPUs,
-                (
-                SELECT 
-                (CASE
-                WHEN elem->>'value' = 'null' THEN NULL
-                ELSE (elem->>'value')::BOOLEAN
-                END)
-                FROM jsonb_array_elements(
-                (item->>'capabilities')::jsonb
-                ) AS elem
-                WHERE elem->>'name' = 'PremiumIO'
-                ) AS  PremiumIO,
-                (
-                SELECT 
-                (CASE
-                WHEN elem->>'value' = 'null' THEN NULL
-                ELSE (elem->>'value')::TEXT
-                END)
-                FROM jsonb_array_elements(
-                (item->>'capabilities')::jsonb
-                ) AS elem
-                WHERE elem->>'name' = 'SupportedEphemeralOSDiskPlacements'
-                ) AS  SupportedEphemeralOSDiskPlacements,
-                (
-                SELECT 
-                (CASE
-                WHEN elem->>'value' = 'null' THEN NULL
-                ELSE (elem->>'value')::TEXT
-                END)
-                FROM jsonb_array_elements(
-                (item->>'capabilities')::jsonb
-                ) AS elem
-                WHERE elem->>'name' = 'ConfidentialComputingType'
-                ) AS  ConfidentialComputingType,
-                (
-                SELECT 
-                (CASE
-                WHEN elem->>'value' = 'null' THEN NULL
-                ELSE (elem->>'value')::TEXT
-                END)
-                FROM jsonb_array_elements(
-                (item->>'capabilities')::jsonb
-                ) AS elem
-                WHERE elem->>'name' = 'DiskControllerTypes'
-                ) AS  DiskControllerTypes,
-                (
-                SELECT 
-                (CASE
-                WHEN elem->>'value' = 'null' THEN NULL
-                ELSE (elem->>'value')::INT
-                END)
-                FROM jsonb_array_elements(
-                (item->>'capabilities')::jsonb
-                ) AS elem
-                WHERE elem->>'name' = 'ACUs'
-                ) AS  ACUs,
-                (
-                SELECT 
-                (CASE
-                WHEN elem->>'value' = 'null' THEN NULL
-                ELSE (elem->>'value')::BOOLEAN
-                END)
-                FROM jsonb_array_elements(
-                (item->>'capabilities')::jsonb
-                ) AS elem
-                WHERE elem->>'name' = 'MemoryPreservingMaintenanceSupported'
-                ) AS  MemoryPreservingMaintenanceSupported,
-                (
-                SELECT 
-                (CASE
-                WHEN elem->>'value' = 'null' THEN NULL
-                ELSE (elem->>'value')::BOOLEAN
-                END)
-                FROM jsonb_array_elements(
-                (item->>'capabilities')::jsonb
-                ) AS elem
-                WHERE elem->>'name' = 'EncryptionAtHostSupported'
-                ) AS  EncryptionAtHostSupported,
-                (
-                SELECT 
-                (CASE
-                WHEN elem->>'value' = 'null' THEN NULL
-                ELSE (elem->>'value')::INT
-                END)
-                FROM jsonb_array_elements(
-                (item->>'capabilities')::jsonb
-                ) AS elem
-                WHERE elem->>'name' = 'MaxNetworkInterfaceS'
-                ) AS  MaxNetworkInterfaceS,
-                (
-                SELECT 
-                (CASE
-                WHEN elem->>'value' = 'null' THEN NULL
-                ELSE (elem->>'value')::BOOLEAN
-                END)
-                FROM jsonb_array_elements(
-                (item->>'capabilities')::jsonb
-                ) AS elem
-                WHERE elem->>'name' = 'HibernationSupported'
-                ) AS  HibernationSupported,
-                (
-                SELECT 
-                (CASE
-                WHEN elem->>'value' = 'null' THEN NULL
-                ELSE (elem->>'value')::NUMERIC
-                END)
-                FROM jsonb_array_elements(
-                (item->>'capabilities')::jsonb
-                ) AS elem
-                WHERE elem->>'name' = 'UncachedDiskBytesPerSecond'
-                ) AS  UncachedDiskBytesPerSecond,
-                (
-                SELECT 
-                (CASE
-                WHEN elem->>'value' = 'null' THEN NULL
-                ELSE (elem->>'value')::BOOLEAN
-                END)
-                FROM jsonb_array_elements(
-                (item->>'capabilities')::jsonb
-                ) AS elem
-                WHERE elem->>'name' = 'EphemeralOSDiskSupported'
-                ) AS  EphemeralOSDiskSupported,
-                (
-                SELECT 
-                (CASE
-                WHEN elem->>'value' = 'null' THEN NULL
-                ELSE (elem->>'value')::INT
-                END)
-                FROM jsonb_array_elements(
-                (item->>'capabilities')::jsonb
-                ) AS elem
-                WHERE elem->>'name' = 'GPUs'
-                ) AS  GPUs,
-                (
-                SELECT 
-                (CASE
-                WHEN elem->>'value' = 'null' THEN NULL
-                ELSE (elem->>'value')::BOOLEAN
-                END)
-                FROM jsonb_array_elements(
-                (item->>'capabilities')::jsonb
-                ) AS elem
-                WHERE elem->>'name' = 'AcceleratedNetworkingEnabled'
-                ) AS  AcceleratedNetworkingEnabled,
-                (
-                SELECT 
-                (CASE
-                WHEN elem->>'value' = 'null' THEN NULL
-                ELSE (elem->>'value')::NUMERIC
-                END)
-                FROM jsonb_array_elements(
-                (item->>'capabilities')::jsonb
-                ) AS elem
-                WHERE elem->>'name' = 'CombinedTempDiskAndCachedWriteBytesPerSecond'
-                ) AS CombinedTempDiskAndCachedWriteBytesPerSecond,
-
-
-
-                (
-                CASE
-                WHEN item->>'capacity' = 'null' THEN NULL
-                ELSE item->>'capacity'
-                END
-                ) AS capacity,
-                (
-                CASE
-                WHEN item->>'costs' = 'null' THEN NULL
-                ELSE item->>'costs'
-                END
-                ) AS costs,
-                (
-                CASE
-                WHEN item->>'family' = 'null' THEN NULL
-                ELSE item->>'family'
-                END
-                ) AS family,
-                (
-                CASE
-                WHEN item->>'kind' = 'null' THEN NULL
-                ELSE item->>'kind'
-                END
-                ) AS kind,
-                (
-                CASE
-                WHEN item->'locationInfo' IS NULL THEN NULL
-                ELSE item->'locationInfo'
-                END
-                ) AS location_info,
-                (SELECT jsonb_array_elements_text((item->>'locations')::jsonb)) AS locations,
-            
-                (
-                CASE
-                WHEN item->>'name' = 'null' THEN NULL
-                ELSE item->>'name'
-                END
-                ) AS name,
-                (
-                CASE
-                WHEN item->>'resourceType' = 'null' THEN NULL
-                ELSE item->>'resourceType'
-                END
-                ) AS resource_type,
-                (
-                CASE
-                WHEN item->'restrictions' = '"[]"' THEN NULL
-                ELSE item->'restrictions'
-                END
-                ) AS restrictions,
-                (
-                CASE
-                WHEN item->>'size' = 'null' THEN NULL
-                ELSE item->>'size'
-                END
-                ) AS size,
-                (
-                CASE
-                WHEN item->>'tier' = 'null' THEN NULL
-                ELSE item->>'tier'
-                END
-                ) AS tier,
-                CURRENT_TIMESTAMP AS run_timestamp
-                FROM split_data ;
-                        """
+    if LOAD_METHOD == 'copy':
+        return copy_into_sku_table('virtualMachines', v_data)
+    query = sku_pivot_insert_query('virtualMachines')
     try:
         pgcur.execute(query,(v_data,))
         logging.info("Data inserted into the table virtualMachines")
@@ -1708,6 +1288,58 @@ def create_table_azure_rates():
         logging.info("Table created : azure_rates")
     except psycopg2.Error as e:
         logging.error(f"Error in creating table azure_rates :{e}")
+    create_columns_azure_rates_classification()
+    create_managed_indexes('azure_rates')
+
+# Revision of the pricing_kind expression, recorded as the column comment
+PRICING_KIND_REVISION = '2'
+
+def rebuild_outdated_pricing_kind():
+    """Drop a pricing_kind column generated by an older expression so it is added again with the current one"""
+
+    pgcur.execute("""SELECT col_description(attrelid, attnum) FROM pg_attribute
+                     WHERE attrelid = to_regclass('azure_rates') AND attname = 'pricing_kind' AND NOT attisdropped""")
+    row = pgcur.fetchone()
+    if row and row[0] != 'revision %s' % PRICING_KIND_REVISION:
+        pgcur.execute("ALTER TABLE azure_rates DROP COLUMN pricing_kind")
+        logging.info("Dropped the outdated pricing_kind column of azure_rates")
+
+def create_columns_azure_rates_classification():
+    """Add the columns classifying each rate row, computed once when the row is written
+
+    os, pricing_kind and term_years follow the sku_name/product_name rules
+    the vm_pricing join used to evaluate for every joined row.
+    """
+
+    query = """
+        ALTER TABLE azure_rates
+            ADD COLUMN IF NOT EXISTS os VARCHAR(10) GENERATED ALWAYS AS (
+                CASE
+                    WHEN product_name LIKE '%Windows' THEN 'Windows'
+                    WHEN product_name LIKE '%Series' OR product_name LIKE '%Basic' THEN 'Linux'
+                END) STORED,
+            ADD COLUMN IF NOT EXISTS pricing_kind VARCHAR(20) GENERATED ALWAYS AS (
+                CASE
+                    WHEN type = 'Reservation' THEN 'reservation'
+                    WHEN type <> 'Consumption' THEN NULL
+                    WHEN sku_name LIKE '%Low Priority' THEN 'low-priority'
+                    WHEN sku_name LIKE '%Spot'
+                        OR ARRAY_LENGTH(REGEXP_SPLIT_TO_ARRAY(sku_name, '\\s+'), 1) = 3
+                    THEN 'spot'
+                    WHEN ARRAY_LENGTH(REGEXP_SPLIT_TO_ARRAY(sku_name, '\\s+'), 1) <= 2 THEN 'on-demand'
+                END) STORED,
+            ADD COLUMN IF NOT EXISTS term_years SMALLINT GENERATED ALWAYS AS (
+                SUBSTRING(reservation_term FROM '^[0-9]+')::SMALLINT) STORED,
+            ADD COLUMN IF NOT EXISTS product_series VARCHAR(50) GENERATED ALWAYS AS (
+                SUBSTRING(product_name FROM '^Virtual Machines (.+) Series')) STORED;
+        """
+    try:
+        rebuild_outdated_pricing_kind()
+        pgcur.execute(query)
+        pgcur.execute("COMMENT ON COLUMN azure_rates.pricing_kind IS %s", ('revision %s' % PRICING_KIND_REVISION,))
+        logging.info("Classification columns created : azure_rates")
+    except psycopg2.Error as e:
+        logging.error(f"Error in creating classification columns of azure_rates :{e}")
 
 def truncate_table_azure_rates():
     """Truncate table azure_rates"""
@@ -1718,12 +1350,368 @@ def truncate_table_azure_rates():
     except psycopg2.Error as e:
         logging.critical(f"Error in truncating azure_rates table:{e}")
 
+rates_session = None
+rates_session_lock = threading.Lock()
+rates_fetch_stats = {'pages': 0, 'seconds': 0.0, 'wire_bytes': 0, 'decoded_bytes': 0, 'retries': 0}
+
+def get_rates_session():
+    """Return the pooled keep-alive HTTP session shared by the rates crawl"""
+
+    global rates_session
+    with rates_session_lock:
+        if rates_session is None:
+            session = requests.Session()
+            # One pooled connection per in-flight page plus the sequential walker
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=max(1, RATES_FETCH_CONCURRENCY) + 1,
+                                  pool_block=True)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            # gzip/deflate always, br when urllib3 has a brotli decoder installed
+            session.headers.update(make_headers(keep_alive=True, accept_encoding=True))
+            rates_session = session
+    return rates_session
+
+def reset_rates_fetch_stats():
+    """Reset the transfer counters of the rates crawl"""
+
+    with rates_session_lock:
+        rates_fetch_stats.update(pages=0, seconds=0.0, wire_bytes=0, decoded_bytes=0, retries=0)
+
+def record_rates_page(api_url, elapsed, response, decoded_bytes=None):
+    """Log the latency and size of a fetched rates page and add them to the crawl totals"""
+
+    # tell() counts the bytes read from the socket, before content decoding
+    wire_bytes = response.raw.tell() if response.raw is not None else 0
+    if decoded_bytes is None:
+        decoded_bytes = len(response.content)
+    with rates_session_lock:
+        rates_fetch_stats['pages'] += 1
+        rates_fetch_stats['seconds'] += elapsed
+        rates_fetch_stats['wire_bytes'] += wire_bytes
+        rates_fetch_stats['decoded_bytes'] += decoded_bytes
+    if prometheus_client is not None:
+        RATES_PAGES.inc()
+        RATES_HTTP_SECONDS.observe(elapsed)
+    logging.debug(f"Fetched rates page $skip={rates_page_skip(api_url)} in {elapsed:.3f}s:"
+                  f" {wire_bytes} bytes transferred, {decoded_bytes} bytes decoded"
+                  f" ({response.headers.get('Content-Encoding', 'identity')})")
+
+def log_rates_fetch_stats():
+    """Log the transfer totals of the rates crawl"""
+
+    with rates_session_lock:
+        stats = dict(rates_fetch_stats)
+    average = stats['seconds'] / stats['pages'] if stats['pages'] else 0.0
+    logging.info(f"Fetched {stats['pages']} rates pages: {stats['wire_bytes']} bytes transferred,"
+                 f" {stats['decoded_bytes']} bytes decoded, {average:.3f}s average page latency,"
+                 f" {stats['retries']} retries")
+    record_stage_metrics(pages=stats['pages'], payload_bytes=stats['decoded_bytes'], retries=stats['retries'])
+
+# Columns of azure_rates filled from the prices API, in load order
+AZURE_RATES_COLUMNS = [
+    'currency_code',
+    'tier_minimum_units',
+    'reservation_term',
+    'retail_price',
+    'unit_price',
+    'arm_region_name',
+    'location',
+    'effective_start_date',
+    'meter_id',
+    'meter_name',
+    'product_id',
+    'sku_id',
+    'product_name',
+    'sku_name',
+    'service_name',
+    'service_id',
+    'service_family',
+    'unit_of_measure',
+    'type',
+    'is_primary_meter_region',
+    'arm_sku_name',
+    'savings_plan_unit_price_3y',
+    'savings_plan_retail_price_3y',
+    'savings_plan_term_3y',
+    'savings_plan_unit_price_1y',
+    'savings_plan_retail_price_1y',
+    'savings_plan_term_1y',
+    'run_timestamp',
+]
+# A price point is identified by its meter, sku, price type, term and tier
+AZURE_RATES_KEY_COLUMNS = ('currency_code', 'meter_id', 'sku_id', 'type', 'reservation_term', 'tier_minimum_units')
+AZURE_RATES_NATURAL_KEY = "currency_code, meter_id, sku_id, type, (COALESCE(reservation_term, '')), tier_minimum_units"
+
+def azure_rates_insert_query(source):
+    """Return the statement inserting every price point in source"""
+
+    columns = ",\n                    ".join(AZURE_RATES_COLUMNS)
+    return f"""
+                INSERT INTO azure_rates (
+                    {columns}
+                )
+                SELECT
+                    {columns}
+                FROM {source}
+                """
+
+def azure_rates_upsert_query(source):
+    """Return the statement upserting the newest price point of each natural key in source"""
+
+    columns = ",\n                    ".join(AZURE_RATES_COLUMNS)
+    updates = ",\n                    ".join("%s = EXCLUDED.%s" % (column, column)
+                                          for column in AZURE_RATES_COLUMNS
+                                          if column not in AZURE_RATES_KEY_COLUMNS)
+    return f"""
+                INSERT INTO azure_rates (
+                    {columns}
+                )
+                SELECT DISTINCT ON ({AZURE_RATES_NATURAL_KEY})
+                    {columns}
+                FROM {source}
+                ORDER BY {AZURE_RATES_NATURAL_KEY}, effective_start_date DESC
+                ON CONFLICT ({AZURE_RATES_NATURAL_KEY})
+                DO UPDATE SET
+                    {updates}
+                WHERE azure_rates.effective_start_date <= EXCLUDED.effective_start_date
+                """
+
+def flatten_rate_item(item, run_timestamp):
+    """Flatten a prices API item into an azure_rates row in COPY text form"""
+
+    savings_plan = item.get('savingsPlan') or []
+    savings_3y = savings_plan[0] if len(savings_plan) > 0 else {}
+    savings_1y = savings_plan[1] if len(savings_plan) > 1 else {}
+    effective_start_date = item.get('effectiveStartDate')
+    return (
+        item.get('currencyCode'),
+        item.get('tierMinimumUnits'),
+        item.get('reservationTerm'),
+        item.get('retailPrice'),
+        item.get('unitPrice'),
+        item.get('armRegionName'),
+        item.get('location'),
+        # the INSERT path casts effectiveStartDate to DATE
+        effective_start_date[:10] if effective_start_date else None,
+        item.get('meterId'),
+        item.get('meterName'),
+        item.get('productId'),
+        item.get('skuId'),
+        item.get('productName'),
+        item.get('skuName'),
+        item.get('serviceName'),
+        item.get('serviceId'),
+        item.get('serviceFamily'),
+        item.get('unitOfMeasure'),
+        item.get('type'),
+        item.get('isPrimaryMeterRegion'),
+        item.get('armSkuName'),
+        savings_3y.get('unitPrice'),
+        savings_3y.get('retailPrice'),
+        savings_3y.get('term'),
+        savings_1y.get('unitPrice'),
+        savings_1y.get('retailPrice'),
+        savings_1y.get('term'),
+        run_timestamp,
+    )
+
+def copy_into_azure_rates(r_data, upsert=False):
+    """Load rates into azure_rates by streaming them with COPY into a session temp table
+
+    r_data is either the JSON text of a page's Items or the row tuples
+    already decoded by fetch_data_rates_rows(). With upsert only the newest
+    price point of each natural key is kept.
+    """
+
+    if isinstance(r_data, str):
+        run_timestamp = utc_now_text()
+        rows = [flatten_rate_item(item, run_timestamp) for item in json.loads(r_data, parse_float=Decimal)]
+    else:
+        rows = r_data
+    try:
+        pgcur.execute("""CREATE TEMP TABLE IF NOT EXISTS azure_rates_page AS
+                         SELECT %s FROM azure_rates WITH NO DATA""" % ", ".join(AZURE_RATES_COLUMNS))
+        pgcur.execute("TRUNCATE TABLE azure_rates_page")
+        copy_rows('azure_rates_page', AZURE_RATES_COLUMNS, rows)
+        if upsert:
+            pgcur.execute(azure_rates_upsert_query('azure_rates_page'))
+        else:
+            pgcur.execute(azure_rates_insert_query('azure_rates_page'))
+        logging.info("Copied data into table: Azure rates")
+    except (psycopg2.Error, ValueError) as e:
+        logging.error(f"Error in copying data into azure_rates table:{e}")
+
+def azure_rates_natural_key_indexes(schema=None):
+    """Return the qualified names of the natural key indexes of azure_rates, or of its copy in schema
+
+    The natural key index is the only unique index of azure_rates besides its
+    primary key, whatever it is named; a shadow load's copy of the table
+    carries it under a generated name.
+    """
+
+    table = 'azure_rates' if schema is None else '%s.azure_rates' % schema
+    pgcur.execute("""SELECT quote_ident(n.nspname) || '.' || quote_ident(c.relname)
+                     FROM pg_index i
+                     JOIN pg_class c ON c.oid = i.indexrelid
+                     JOIN pg_namespace n ON n.oid = c.relnamespace
+                     WHERE i.indrelid = %s::regclass AND i.indisunique AND NOT i.indisprimary""", (table,))
+    return [row[0] for row in pgcur.fetchall()]
+
+def create_index_azure_rates_natural_key(schema=None):
+    """Create the unique index identifying a price point in azure_rates, or in its copy in schema, unless it has one"""
+
+    table = 'azure_rates' if schema is None else '%s.azure_rates' % schema
+    try:
+        if azure_rates_natural_key_indexes(schema):
+            return True
+        pgcur.execute("CREATE UNIQUE INDEX azure_rates_natural_key ON %s (%s)" % (table, AZURE_RATES_NATURAL_KEY))
+        logging.info(f"Index created : azure_rates_natural_key on {table}")
+        return True
+    except psycopg2.Error as e:
+        logging.error(f"Error in creating index azure_rates_natural_key:{e}")
+        return False
+
+def drop_index_azure_rates_natural_key(schema=None):
+    """Drop the unique natural key index of azure_rates, or of its copy in schema, a full sync keeps every price point of the API"""
+
+    try:
+        for index in azure_rates_natural_key_indexes(schema):
+            pgcur.execute("DROP INDEX %s" % index)
+            logging.info(f"Dropped index : {index}")
+    except psycopg2.Error as e:
+        logging.error(f"Error in dropping index azure_rates_natural_key:{e}")
+
+def create_table_rates_sync_state():
+    """Create table rates_sync_state holding the high-water mark of the last completed rates crawl"""
+
+    query = """
+        CREATE TABLE IF NOT EXISTS rates_sync_state(
+                    crawl_url TEXT PRIMARY KEY,
+                    high_water_mark TIMESTAMP,
+                    full_reload_at TIMESTAMP,
+                    updated_at TIMESTAMP)
+            """
+    try:
+        pgcur.execute(query)
+        logging.info("Table Created: rates_sync_state")
+    except psycopg2.Error as e:
+        logging.error(f"Error creating table rates_sync_state:{e}")
+
+def fetch_rates_sync_state(crawl_url):
+    """Return the high-water mark of the completed crawls of crawl_url and whether a reconciling full reload is due
+
+    None when no crawl of crawl_url completed since azure_rates was last reloaded.
+    """
+
+    try:
+        pgcur.execute("""SELECT high_water_mark,
+                                full_reload_at IS NULL OR full_reload_at < LOCALTIMESTAMP - %s * INTERVAL '1 day'
+                         FROM rates_sync_state WHERE crawl_url = %s""", (RATES_RECONCILE_DAYS, crawl_url))
+        return pgcur.fetchone()
+    except psycopg2.Error as e:
+        logging.error(f"Error in fetching the azure_rates high-water mark:{e}")
+
+def record_rates_sync_state(crawl_url, full_reload):
+    """Record the latest effective_start_date of azure_rates as the high-water mark of a completed crawl
+
+    A full reload replaces azure_rates, so the marks of other crawls are dropped.
+    """
+
+    try:
+        if full_reload:
+            pgcur.execute("DELETE FROM rates_sync_state WHERE crawl_url <> %s", (crawl_url,))
+        pgcur.execute("""INSERT INTO rates_sync_state (crawl_url, high_water_mark, full_reload_at, updated_at)
+                         SELECT %s, MAX(effective_start_date), CASE WHEN %s THEN LOCALTIMESTAMP END, LOCALTIMESTAMP
+                         FROM azure_rates
+                         ON CONFLICT (crawl_url) DO UPDATE SET
+                             high_water_mark = EXCLUDED.high_water_mark,
+                             full_reload_at = COALESCE(EXCLUDED.full_reload_at, rates_sync_state.full_reload_at),
+                             updated_at = EXCLUDED.updated_at""", (crawl_url, full_reload))
+        logging.info("Recorded the azure_rates high-water mark")
+    except psycopg2.Error as e:
+        logging.error(f"Error in recording the azure_rates high-water mark:{e}")
+
+def add_rates_filter(api_url, clause):
+    """AND an OData clause into the $filter of a rates url"""
+
+    parts = urlsplit(api_url)
+    query = parse_qsl(parts.query)
+    filters = [v for k, v in query if k == '$filter']
+    query = [(k, v) for k, v in query if k != '$filter']
+    query.append(('$filter', " and ".join(["(%s)" % f for f in filters] + [clause])))
+    return urlunsplit(parts._replace(query=urlencode(query, safe="$'", quote_via=quote)))
+
+class CountingReader:
+    """Wrap a binary stream and count the bytes read from it"""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self.bytes_read += len(data)
+        return data
+
+def parse_rates_page(stream, run_timestamp):
+    """Decode a prices API page into azure_rates rows and its NextPageLink
+
+    With ijson the body is decoded incrementally and each item is flattened as
+    soon as it is complete, so only the row tuples of the page are kept.
+    """
+
+    rows = []
+    next_url = None
+    if ijson is None:
+        json_data = json.loads(stream.read(), parse_float=Decimal)
+        for item in json_data.get("Items", []):
+            rows.append(flatten_rate_item(item, run_timestamp))
+        return json_data.get("NextPageLink"), rows
+
+    builder = None
+    for prefix, event, value in ijson.parse(stream):
+        if prefix == 'Items.item' and event == 'start_map':
+            builder = ijson.ObjectBuilder()
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == 'Items.item' and event == 'end_map':
+                rows.append(flatten_rate_item(builder.value, run_timestamp))
+                builder = None
+        elif prefix == 'NextPageLink':
+            next_url = value
+    return next_url, rows
+
+# Errors raised while a streamed rates page is read and decoded
+RATES_DECODE_ERRORS = (urllib3.exceptions.HTTPError, ValueError) + ((ijson.JSONError,) if ijson else ())
+
+def fetch_data_rates_rows(api_url):
+    """Fetch a rates page as azure_rates row tuples, decoding the body while it streams in"""
+
+    try:
+        started = time.perf_counter()
+        with get_rates_session().get(api_url, timeout=RATES_HTTP_TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            stream = CountingReader(response.raw)
+            next_url, rows = parse_rates_page(stream, utc_now_text())
+            record_rates_page(api_url, time.perf_counter() - started, response, stream.bytes_read)
+        return next_url, rows
+
+    except (requests.exceptions.RequestException,) + RATES_DECODE_ERRORS as e:
+            logging.error(f"Error fetching Azure VM rates : {e}")
+            raise
+
 def fetch_data_rates(api_url):
     """Fetch Azure rates data"""
 
+    if LOAD_METHOD == 'copy':
+        return fetch_data_rates_rows(api_url)
     try:
-        response = requests.get(api_url)
+        started = time.perf_counter()
+        response = get_rates_session().get(api_url, timeout=RATES_HTTP_TIMEOUT)
         response.raise_for_status()
+        record_rates_page(api_url, time.perf_counter() - started, response)
         json_data = response.json()
         vm_rates = json_data.get("Items", [])   
         processed_data = json.dumps(vm_rates) 
@@ -1732,82 +1720,493 @@ def fetch_data_rates(api_url):
     
     except requests.exceptions.RequestException as e:
             logging.error(f"Error fetching Azure VM rates : {e}")
-            logging.info(f"Retrying in 5 seconds...")
-            time.sleep(5)
-def insert_into_azure_rates(r_data):
-    """Insert data into azure_rates table"""
+            raise
+
+def fetch_vm_regions():
+    """Return the regions present in the virtualMachines table"""
+
+    try:
+        pgcur.execute("""SELECT DISTINCT locations FROM virtualMachines
+                         WHERE locations IS NOT NULL ORDER BY locations""")
+        return [row[0] for row in pgcur.fetchall()]
+    except psycopg2.Error as e:
+        logging.error(f"Error in fetching regions from virtualMachines table:{e}")
+        return []
+
+def odata_literal(value):
+    """Quote a string as an OData literal"""
+
+    return "'%s'" % value.replace("'", "''")
+
+def build_rates_filter(regions):
+    """Build the OData $filter selecting the virtual machine prices of the given regions"""
+
+    clauses = ["serviceName eq 'Virtual Machines'"]
+    if regions:
+        clauses.append("(%s)" % " or ".join("armRegionName eq %s" % odata_literal(region)
+                                            for region in regions))
+    return " and ".join(clauses)
+
+def build_rates_api_url(mode=None):
+    """Return the url of the first rates page for the configured crawl mode"""
+
+    mode = mode or RATES_CRAWL_MODE
+    if mode == 'full':
+        return RATES_API_URL
+    if mode != 'filtered':
+        logging.warning(f"Unknown rates crawl mode {mode}, crawling the full catalogue")
+        return RATES_API_URL
+    regions = fetch_vm_regions()
+    if not regions:
+        logging.warning("No regions in virtualMachines, filtering the rates crawl on service only")
+    parts = urlsplit(RATES_API_URL)
+    query = parse_qsl(parts.query)
+    query.append(('currencyCode', odata_literal(RATES_CURRENCY_CODE)))
+    query.append(('$filter', build_rates_filter(regions)))
+    api_url = urlunsplit(parts._replace(query=urlencode(query, safe="$'", quote_via=quote)))
+    logging.info(f"Filtered rates crawl over {len(regions)} regions in {RATES_CURRENCY_CODE}")
+    return api_url
+
+def rates_page_skip(api_url):
+    """Return the $skip offset of a rates page url"""
+
+    query = dict(parse_qsl(urlsplit(api_url).query))
+    return int(query.get('$skip', 0))
+
+def rates_page_url(api_url, skip):
+    """Build the url of the rates page starting at the given $skip offset"""
+
+    parts = urlsplit(api_url)
+    query = [(k, v) for k, v in parse_qsl(parts.query) if k != '$skip']
+    if skip:
+        query.append(('$skip', str(skip)))
+    return urlunsplit(parts._replace(query=urlencode(query, safe="$'", quote_via=quote)))
+
+class RatesCircuitOpen(requests.exceptions.RequestException):
+    """Requests to a prices API host are suspended after too many consecutive failures"""
+
+class HostThrottle:
+    """Concurrency limit, shared pause and circuit breaker of the rates requests to one host
+
+    A Retry-After pauses every request to the host, not only the throttled one.
+    After RATES_BREAKER_THRESHOLD consecutive failures requests fail fast for
+    RATES_BREAKER_COOLDOWN seconds, then one failure more opens it again.
+    """
+
+    def __init__(self, host, concurrency):
+        self.host = host
+        self.slots = threading.BoundedSemaphore(max(1, concurrency))
+        self.lock = threading.Lock()
+        self.resume_at = 0.0
+        self.failures = 0
+        self.open_until = None
+
+    def acquire(self):
+        """Wait for a free slot and the end of any pause, failing fast while the circuit is open"""
+
+        with self.lock:
+            if self.open_until is not None:
+                if time.monotonic() < self.open_until:
+                    raise RatesCircuitOpen(f"Circuit to {self.host} is open after {self.failures} failures")
+                self.open_until = None
+                self.failures = RATES_BREAKER_THRESHOLD - 1
+        self.slots.acquire()
+        while True:
+            with self.lock:
+                pause = self.resume_at - time.monotonic()
+            if pause <= 0:
+                return
+            time.sleep(pause)
+
+    def release(self, outcome, pause=None):
+        """Free the slot and account a 'success', 'failure' or 'throttled' request, None accounts nothing"""
+
+        self.slots.release()
+        with self.lock:
+            if pause:
+                self.resume_at = max(self.resume_at, time.monotonic() + pause)
+            if outcome == 'success':
+                self.failures = 0
+            elif outcome == 'failure':
+                self.failures += 1
+                if self.failures >= RATES_BREAKER_THRESHOLD and self.open_until is None:
+                    self.open_until = time.monotonic() + RATES_BREAKER_COOLDOWN
+                    logging.critical(f"Opening the circuit to {self.host} for {RATES_BREAKER_COOLDOWN:.0f}s"
+                                     f" after {self.failures} consecutive failures")
+
+rates_host_throttles = {}
+
+def rates_host_throttle(api_url):
+    """Return the HostThrottle of the host of a rates url"""
+
+    host = urlsplit(api_url).netloc
+    with rates_session_lock:
+        if host not in rates_host_throttles:
+            rates_host_throttles[host] = HostThrottle(host, RATES_HOST_CONCURRENCY)
+        return rates_host_throttles[host]
+
+def retry_after_seconds(response):
+    """Return the delay asked for by the Retry-After header of a response, None without one"""
+
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def rates_retry_delay(attempt, retry_after=None):
+    """Return the full-jitter exponential backoff before the next attempt, at least retry_after"""
+
+    delay = random.uniform(0, min(RATES_RETRY_MAX_DELAY, RATES_RETRY_BASE_DELAY * 2 ** attempt))
+    return max(delay, retry_after or 0.0)
+
+def rates_fetch_outcome(error):
+    """Classify a failed rates request as 'throttled', a retryable 'failure', or 'fatal'"""
+
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        if status == 429:
+            return 'throttled'
+        return 'failure' if status == 408 or status >= 500 else 'fatal'
+    return 'failure'
+
+RATES_FETCH_ERRORS = (requests.exceptions.RequestException,) + RATES_DECODE_ERRORS
 
+def fetch_rates_page(api_url):
+    """Fetch one rates page, retrying transient failures with exponential backoff and jitter
+
+    A 429 or 503 Retry-After pauses the whole host for that long. Client
+    errors other than 408 and 429 are not retried.
+    """
+
+    throttle = rates_host_throttle(api_url)
+    attempts = max(1, RATES_RETRY_ATTEMPTS)
+    for attempt in range(attempts):
+        throttle.acquire()
+        released = False
+        try:
+            page = fetch_data_rates(api_url)
+        except RATES_FETCH_ERRORS as e:
+            outcome = rates_fetch_outcome(e)
+            retry_after = retry_after_seconds(getattr(e, 'response', None))
+            throttle.release('failure' if outcome == 'fatal' else outcome, retry_after)
+            released = True
+            if outcome == 'fatal' or attempt + 1 == attempts:
+                raise requests.exceptions.RetryError(f"Giving up on rates page {api_url}"
+                                                     f" after {attempt + 1} attempts:{e}") from e
+            delay = rates_retry_delay(attempt, retry_after)
+            with rates_session_lock:
+                rates_fetch_stats['retries'] += 1
+            logging.warning(f"Retrying rates page {api_url} in {delay:.1f}s ({outcome}, attempt {attempt + 1})")
+            time.sleep(delay)
+        else:
+            throttle.release('success')
+            released = True
+            return page
+        finally:
+            # any other exception still frees the slot, without counting towards the breaker
+            if not released:
+                throttle.release(None)
+
+def fetch_rates_pages(api_url, concurrency=None):
+    """Yield the rates pages with their NextPageLink in order while the next pages are fetched in the background
+
+    The prices API pages with a fixed $skip step, so once the step is known from
+    the first NextPageLink the following page urls are requested ahead of time on
+    a bounded thread pool. Pages are still yielded strictly in page order. If a
+    NextPageLink does not match the predicted url the crawl falls back to
+    following NextPageLink one page at a time.
+    """
+
+    concurrency = max(1, concurrency or RATES_FETCH_CONCURRENCY)
+    next_url, r_data = fetch_rates_page(api_url)
+    yield next_url, r_data
+    if not next_url:
+        return
+    step = rates_page_skip(next_url) - rates_page_skip(api_url)
+    if concurrency == 1 or step <= 0:
+        while next_url:
+            next_url, r_data = fetch_rates_page(next_url)
+            yield next_url, r_data
+        return
+
+    pending = deque()
+    skip = rates_page_skip(next_url)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='rates') as pool:
+        try:
+            while next_url:
+                while len(pending) < concurrency:
+                    pending.append((skip, pool.submit(fetch_rates_page, rates_page_url(api_url, skip))))
+                    skip += step
+                page_skip, future = pending.popleft()
+                next_url, r_data = future.result()
+                yield next_url, r_data
+                if next_url and rates_page_skip(next_url) != page_skip + step:
+                    logging.warning(f"Unexpected NextPageLink {next_url}, following it sequentially")
+                    break
+        finally:
+            for _, future in pending:
+                future.cancel()
+    while next_url:
+        next_url, r_data = fetch_rates_page(next_url)
+        yield next_url, r_data
+
+@measured('insert')
+def insert_into_azure_rates(r_data, upsert=False):
+    """Insert data into azure_rates table, with upsert on the price point natural key"""
+
+    if LOAD_METHOD == 'copy':
+        return copy_into_azure_rates(r_data, upsert)
     query ="""
             WITH split_data AS (
                     SELECT jsonb_array_elements(%s::jsonb) AS item 
+                ),
+                page AS (
+                    SELECT 
+                        item->>'currencyCode' AS currency_code,
+                        (item->>'tierMinimumUnits')::NUMERIC AS tier_minimum_units,
+                        item->>'reservationTerm' AS reservation_term,
+                        (item->>'retailPrice')::NUMERIC AS retail_price,
+                        (item->>'unitPrice')::NUMERIC AS unit_price,
+                        item->>'armRegionName' AS arm_region_name,
+                        item->>'location' AS location,
+                        (item->>'effectiveStartDate')::DATE AS effective_start_date,
+                        item->>'meterId' AS meter_id,
+                        item->>'meterName' AS meter_name,
+                        item->>'productId' AS product_id,
+                        item->>'skuId' AS sku_id,
+                        item->>'productName' AS product_name,
+                        item->>'skuName' AS sku_name,
+                        item->>'serviceName' AS service_name,
+                        item->>'serviceId' AS service_id,
+                        item->>'serviceFamily' AS service_family,
+                        item->>'unitOfMeasure' AS unit_of_measure,
+                        item->>'type' AS type,
+                        (item->>'isPrimaryMeterRegion')::BOOLEAN AS is_primary_meter_region,
+                        item->>'armSkuName' AS arm_sku_name,
+                        (item->'savingsPlan'->0->>'unitPrice')::NUMERIC AS savings_plan_unit_price_3y,
+                        (item->'savingsPlan'->0->>'retailPrice')::NUMERIC AS savings_plan_retail_price_3y,
+                        item->'savingsPlan'->0->>'term' AS savings_plan_term_3y,
+                        (item->'savingsPlan'->1->>'unitPrice')::NUMERIC AS savings_plan_unit_price_1y,
+                        (item->'savingsPlan'->1->>'retailPrice')::NUMERIC AS savings_plan_retail_price_1y,
+                        item->'savingsPlan'->1->>'term' AS savings_plan_term_1y,
+                        CURRENT_TIMESTAMP AS run_timestamp
+                        FROM split_data
                 )
-                INSERT INTO azure_rates (
-                    currency_code, 
-                    tier_minimum_units, 
-                    reservation_term, 
-                    retail_price, 
-                    unit_price,
-                    arm_region_name, 
-                    location, 
-                    effective_start_date, 
-                    meter_id, 
-                    meter_name,
-                    product_id, 
-                    sku_id, 
-                    product_name, 
-                    sku_name, 
-                    service_name,
-                    service_id, 
-                    service_family, 
-                    unit_of_measure, 
-                    type, 
-                    is_primary_meter_region,
-                    arm_sku_name, 
-                    savings_plan_unit_price_3y, 
-                    savings_plan_retail_price_3y, 
-                    savings_plan_term_3y, 
-                    savings_plan_unit_price_1y, 
-                    savings_plan_retail_price_1y, 
-                    savings_plan_term_1y, 
-                    run_timestamp
-                )  
-                SELECT 
-                    item->>'currencyCode' AS currencyCode,
-                    (item->>'tierMinimumUnits')::NUMERIC AS tierMinimumUnits ,
-                    item->>'reservationTerm' AS reservationTerm,
-                    (item->>'retailPrice')::NUMERIC As retailPrice,
-                    (item->>'unitPrice')::NUMERIC AS unitPrice,
-                    item->>'armRegionName' AS armRegionName,
-                    item->>'location' AS location,
-                    (item->>'effectiveStartDate')::DATE AS effectiveStartDate,
-                    item->>'meterId' AS meterId,
-                    item->>'meterName' AS meterName,
-                    item->>'productId' AS productId,
-                    item->>'skuId' AS skuId,
-                    item->>'productName' AS productName,
-                    item->>'skuName' AS skuName,
-                    item->>'serviceName' AS serviceName,
-                    item->>'serviceId' AS serviceId,
-                    item->>'serviceFamily' AS serviceFamily,
-                    item->>'unitOfMeasure' AS unitOfMeasure,
-                    item->>'type' AS type,
-                    (item->>'isPrimaryMeterRegion')::BOOLEAN AS isPrimaryMeterRegion,
-                    item->>'armSkuName' AS armSkuName,
-                    (item->'savingsPlan'->0->>'unitPrice')::NUMERIC AS savings_plan_unit_price_3y,
-                    (item->'savingsPlan'->0->>'retailPrice')::NUMERIC AS savings_plan_retail_price_3y,
-                    item->'savingsPlan'->0->>'term' AS savings_plan_term_3y,
-                    (item->'savingsPlan'->1->>'unitPrice')::NUMERIC AS savings_plan_unit_price_1y,
-                    (item->'savingsPlan'->1->>'retailPrice')::NUMERIC AS savings_plan_retail_price_1y,
-                    item->'savingsPlan'->1->>'term' AS savings_plan_term_1y,
-                    CURRENT_TIMESTAMP AS run_timestamp
-                    FROM split_data
-                    """
+            """ + (azure_rates_upsert_query('page') if upsert else azure_rates_insert_query('page'))
     try:
         pgcur.execute(query,(r_data,))
         logging.info("Inserted data into table: Azure rates")
     except psycopg2.Error as e:
         logging.error(f"Error in inserting data into azure_rates table:{e}")
 
+def create_table_rates_crawl_checkpoint():
+    """Create table rates_crawl_checkpoint holding the progress of an unfinished rates crawl
+
+    A crawl is identified by the url of its crawl mode without the high-water
+    mark filter and by the sync mode. The checkpoint keeps whether the crawl
+    reloads azure_rates in full and the high-water mark it started from.
+    """
+
+    query = """
+        CREATE TABLE IF NOT EXISTS rates_crawl_checkpoint(
+                    crawl_url TEXT PRIMARY KEY,
+                    next_page_link TEXT,
+                    pages INT,
+                    rows BIGINT,
+                    updated_at TIMESTAMP);
+        ALTER TABLE rates_crawl_checkpoint
+            ADD COLUMN IF NOT EXISTS sync_mode VARCHAR(20),
+            ADD COLUMN IF NOT EXISTS full_reload BOOLEAN,
+            ADD COLUMN IF NOT EXISTS high_water_mark TIMESTAMP;
+            """
+    try:
+        pgcur.execute(query)
+        logging.info("Table Created: rates_crawl_checkpoint")
+    except psycopg2.Error as e:
+        logging.error(f"Error creating table rates_crawl_checkpoint:{e}")
+
+def fetch_rates_checkpoint(crawl_url):
+    """Return the next page link, pages, rows, full reload flag and high-water mark of the unfinished crawl of crawl_url
+
+    None to start over. Checkpoints of other crawls or sync modes, or older
+    than RATES_CHECKPOINT_MAX_AGE, are dropped.
+    """
+
+    try:
+        pgcur.execute("""DELETE FROM rates_crawl_checkpoint
+                         WHERE crawl_url <> %s OR sync_mode IS DISTINCT FROM %s
+                            OR updated_at < LOCALTIMESTAMP - %s * INTERVAL '1 hour'""",
+                      (crawl_url, RATES_SYNC_MODE, RATES_CHECKPOINT_MAX_AGE))
+        pgcur.execute("""SELECT next_page_link, pages, rows, full_reload, high_water_mark
+                         FROM rates_crawl_checkpoint WHERE crawl_url = %s""", (crawl_url,))
+        return pgcur.fetchone()
+    except psycopg2.Error as e:
+        logging.error(f"Error in fetching the rates crawl checkpoint:{e}")
+
+def begin_rates_checkpoint(crawl_url, start_url, full_reload, high_water_mark):
+    """Start the checkpoint of a new crawl of crawl_url at its first page"""
+
+    try:
+        pgcur.execute("""INSERT INTO rates_crawl_checkpoint (crawl_url, sync_mode, full_reload, high_water_mark,
+                                                             next_page_link, pages, rows, updated_at)
+                         VALUES (%s, %s, %s, %s, %s, 0, 0, LOCALTIMESTAMP)
+                         ON CONFLICT (crawl_url) DO UPDATE SET
+                             sync_mode = EXCLUDED.sync_mode,
+                             full_reload = EXCLUDED.full_reload,
+                             high_water_mark = EXCLUDED.high_water_mark,
+                             next_page_link = EXCLUDED.next_page_link,
+                             pages = 0,
+                             rows = 0,
+                             updated_at = EXCLUDED.updated_at""",
+                      (crawl_url, RATES_SYNC_MODE, full_reload, high_water_mark, start_url))
+    except psycopg2.Error as e:
+        logging.error(f"Error in starting the rates crawl checkpoint:{e}")
+
+def clear_rates_checkpoint():
+    """Forget the checkpoint of a finished rates crawl"""
+
+    try:
+        pgcur.execute("DELETE FROM rates_crawl_checkpoint")
+        logging.info("Cleared the rates crawl checkpoint")
+    except psycopg2.Error as e:
+        logging.error(f"Error in clearing the rates crawl checkpoint:{e}")
+
+def insert_rates_page_checkpointed(crawl_url, next_url, r_data, upsert=False):
+    """Insert a rates page and move the crawl checkpoint past it in one transaction
+
+    A page the insert rejects is rolled back to a savepoint and the checkpoint
+    still moves on. Returns False for a rejected page.
+    """
+
+    pgcur.execute("BEGIN")
+    try:
+        pgcur.execute("SAVEPOINT rates_page")
+        insert_into_azure_rates(r_data, upsert)
+        inserted = connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_INERROR
+        if inserted:
+            rows = max(pgcur.rowcount, 0)
+        else:
+            pgcur.execute("ROLLBACK TO SAVEPOINT rates_page")
+            rows = 0
+        pgcur.execute("""UPDATE rates_crawl_checkpoint SET
+                             next_page_link = %s,
+                             pages = pages + 1,
+                             rows = rows + %s,
+                             updated_at = LOCALTIMESTAMP
+                         WHERE crawl_url = %s""", (next_url, rows, crawl_url))
+        pgcur.execute("COMMIT")
+    except psycopg2.Error:
+        pgcur.execute("ROLLBACK")
+        raise
+    return inserted
+
+def plan_rates_sync(crawl_url, full_reload=None):
+    """Return whether a new crawl of crawl_url reloads azure_rates in full, and otherwise the high-water mark it starts from
+
+    The incremental sync mode reloads in full without the high-water mark of
+    a completed crawl or once the last full reload is RATES_RECONCILE_DAYS old.
+    """
+
+    if full_reload is None:
+        full_reload = RATES_SYNC_MODE != 'incremental'
+    if full_reload:
+        return True, None
+    state = None
+    if create_index_azure_rates_natural_key():
+        state = fetch_rates_sync_state(crawl_url)
+    if state is None or state[0] is None:
+        logging.info("No high-water mark of a completed rates crawl, falling back to a full reload")
+        return True, None
+    if RATES_RECONCILE_DAYS > 0 and state[1]:
+        # a meter can be published with an effectiveStartDate below the mark
+        logging.info(f"Last full azure_rates reload is over {RATES_RECONCILE_DAYS} days old, reconciling")
+        return True, None
+    logging.info(f"Incremental azure_rates sync from {state[0]}")
+    return False, state[0]
+
+def sync_azure_rates(full_reload=None):
+    """Load azure_rates, from the high-water mark of the last completed crawl unless a full reload is due
+
+    The incremental sync mode upserts on the price point natural key, the
+    mark is only recorded once a crawl completed. An interrupted crawl is
+    resumed from its checkpoint with the full reload flag and high-water mark
+    it started with.
+    """
+
+    upsert = RATES_SYNC_MODE == 'incremental'
+    crawl_url = build_rates_api_url()
+    create_table_rates_sync_state()
+    create_table_rates_crawl_checkpoint()
+    checkpoint = fetch_rates_checkpoint(crawl_url)
+    if checkpoint and checkpoint[0] is None:
+        # the last page went in but the run stopped before finishing the load
+        logging.info("The checkpointed rates crawl had fetched its last page, restarting it")
+        checkpoint = None
+    if checkpoint and full_reload and not checkpoint[3]:
+        logging.info("A full reload was requested, dropping the checkpoint of the incremental rates crawl")
+        checkpoint = None
+    if checkpoint and checkpoint[3] and TABLE_LOAD_MODE == 'shadow' and not staging_table_exists('azure_rates'):
+        logging.warning("The staging azure_rates of the checkpoint is gone, restarting the rates crawl")
+        checkpoint = None
+    if checkpoint:
+        start_url, pages, rows, full_reload, high_water_mark = checkpoint
+        logging.info(f"Resuming the rates crawl after {pages} pages and {rows} rows at {start_url}"
+                     f"{'' if high_water_mark is None else f' from the high-water mark {high_water_mark}'}")
+    else:
+        full_reload, high_water_mark = plan_rates_sync(crawl_url, full_reload)
+        start_url = crawl_url
+        if high_water_mark is not None:
+            # ge rather than gt: price points of the same day may not all be stored yet
+            start_url = add_rates_filter(crawl_url, "effectiveStartDate ge %sZ" % high_water_mark.strftime('%Y-%m-%dT%H:%M:%S'))
+        begin_rates_checkpoint(crawl_url, start_url, full_reload, high_water_mark)
+    if full_reload:
+        # a shadow load fills the staging copy, whose indexes were copied from the live table
+        schema = STAGING_SCHEMA if TABLE_LOAD_MODE == 'shadow' else None
+        with table_load('azure_rates', truncate_table_azure_rates, resume=checkpoint is not None) as load:
+            if upsert:
+                create_index_azure_rates_natural_key(schema)
+            else:
+                drop_index_azure_rates_natural_key(schema)
+            crawl_azure_rates(crawl_url, start_url, upsert)
+        if not load['replaced']:
+            logging.critical("The reloaded azure_rates was not swapped in, keeping the recorded high-water mark")
+            return
+    else:
+        crawl_azure_rates(crawl_url, start_url, upsert)
+        analyze_table('azure_rates')
+    record_rates_sync_state(crawl_url, full_reload)
+
+def crawl_azure_rates(crawl_url, start_url=None, upsert=False):
+    """Insert every rates page of the crawl of crawl_url from start_url into azure_rates, checkpointing after each page
+
+    Raises IncompleteLoad when the crawl stops before its last page and
+    RejectedRatesPages when the database rejected some of its pages, so a
+    partial crawl is never swapped in or recorded as complete.
+    """
+
+    reset_rates_fetch_stats()
+    rejected = 0
+    try:
+        for next_url, r_data in fetch_rates_pages(start_url or crawl_url):
+            if not insert_rates_page_checkpointed(crawl_url, next_url, r_data, upsert):
+                rejected += 1
+    except (requests.exceptions.RequestException, psycopg2.Error) as e:
+        logging.critical(f"Error in crawling Azure rates, the next run resumes from the checkpoint:{e}")
+        raise IncompleteLoad(f"Rates crawl of {crawl_url} interrupted") from e
+    finally:
+        log_rates_fetch_stats()
+    clear_rates_checkpoint()
+    if rejected:
+        logging.critical(f"{rejected} rates pages were rejected, discarding the rates crawl")
+        raise RejectedRatesPages(f"{rejected} pages of the rates crawl of {crawl_url} rejected")
+
 def create_table_vm_pricing():
         """Create table vm_pricing to store virtual machines and cost and characteristics"""
 
@@ -1845,11 +2244,10 @@ def truncate_table_vm_pricing():
     except psycopg2.Error as e:
         logging.critical(f"Error in truncating vm_pricing table:{e}")
 
-def insert_into_vm_pricing_join_operation():
-    """Insert into the vm_pricing table"""
-
-    query = """
-            INSERT INTO vm_pricing 
+# Aggregate of the rates of each virtual machine size and region into one vm_pricing row.
+# The spot columns take the spot rates and, as they always have, the three word
+# 'Low Priority' names, but not the longer ones such as 'D2s v3 Low Priority'
+VM_PRICING_JOIN_QUERY = """
             SELECT 
                 vm.name AS Name,
                 vm.locations AS Location,
@@ -1857,77 +2255,59 @@ def insert_into_vm_pricing_join_operation():
                 vm.vcpus AS vCPUs,
                 CAST(vm.gpus AS INTEGER) AS Instance_Storage,
                 MAX(CASE 
-                        WHEN (ARRAY_LENGTH(REGEXP_SPLIT_TO_ARRAY(rates.sku_name, '\\s+'), 1) = 1 OR
-                            (rates.sku_name NOT LIKE '%Spot' AND ARRAY_LENGTH(REGEXP_SPLIT_TO_ARRAY(rates.sku_name, '\\s+'), 1) = 2))
-                            AND rates.type = 'Consumption' 
-                            AND (rates.product_name LIKE '%Series' OR rates.product_name LIKE '%Basic')
+                        WHEN rates.os = 'Linux' AND rates.pricing_kind = 'on-demand'
                         THEN rates.unit_price 
                     END) AS Linux_On_Demand_Cost,
                 MAX(CASE 
-                        WHEN rates.type = 'Consumption'
-                            AND (rates.product_name LIKE '%Series' OR rates.product_name LIKE '%Basic')
+                        WHEN rates.os = 'Linux' AND rates.type = 'Consumption'
                             AND rates.savings_plan_term_1y = '1 Year'
                         THEN rates.savings_plan_unit_price_1y
                     END) AS Linux_Savings_Price_1_Year,
                 MAX(CASE 
-                        WHEN rates.type = 'Consumption' 
-                            AND (rates.product_name LIKE '%Series' OR rates.product_name LIKE '%Basic')
-                            AND rates.savings_plan_term_3y= '3 Years'
+                        WHEN rates.os = 'Linux' AND rates.type = 'Consumption'
+                            AND rates.savings_plan_term_3y = '3 Years'
                         THEN rates.savings_plan_unit_price_3y
                     END) AS Linux_Savings_Price_3_Years,
                 MAX(CASE 
-                        WHEN ((rates.reservation_term = '1 Year') 
-                            AND rates.type = 'Reservation') 
-                            AND (rates.product_name LIKE '%Series' OR rates.product_name LIKE '%Basic')
-                        THEN rates.unit_price  / 8760
+                        WHEN rates.os = 'Linux' AND rates.pricing_kind = 'reservation' AND rates.term_years = 1
+                        THEN rates.unit_price / 8760
                     END) AS Linux_Reservation_1_Year,
                 MAX(CASE 
-                        WHEN ((rates.reservation_term = '3 Years') 
-                            AND rates.type = 'Reservation') 
-                            AND (rates.product_name LIKE '%Series' OR rates.product_name LIKE '%Basic')
+                        WHEN rates.os = 'Linux' AND rates.pricing_kind = 'reservation' AND rates.term_years = 3
                         THEN rates.unit_price / (3 * 8760)
                     END) AS Linux_Reservation_3_Years,
                 MAX(CASE 
-                        WHEN ((rates.sku_name LIKE '%Spot' OR ARRAY_LENGTH(REGEXP_SPLIT_TO_ARRAY(rates.sku_name, '\\s+'), 1) = 3) 
-                            AND rates.type = 'Consumption') 
-                            AND (rates.product_name LIKE '%Series' OR rates.product_name LIKE '%Basic')
+                        WHEN rates.os = 'Linux' AND (rates.pricing_kind = 'spot'
+                            OR (rates.pricing_kind = 'low-priority'
+                                AND ARRAY_LENGTH(REGEXP_SPLIT_TO_ARRAY(rates.sku_name, '\\s+'), 1) = 3))
                         THEN rates.unit_price 
                     END) AS Linux_Spot_Cost,
                 MAX(CASE 
-                        WHEN (ARRAY_LENGTH(REGEXP_SPLIT_TO_ARRAY(rates.sku_name, '\\s+'), 1) = 1 OR
-                            (rates.sku_name NOT LIKE '%Spot' AND ARRAY_LENGTH(REGEXP_SPLIT_TO_ARRAY(rates.sku_name, '\\s+'), 1) = 2))
-                            AND rates.type = 'Consumption' 
-                            AND rates.product_name LIKE '%Windows' 
+                        WHEN rates.os = 'Windows' AND rates.pricing_kind = 'on-demand'
                         THEN rates.unit_price
                     END) AS Windows_On_Demand_Cost,
                 MAX(CASE 
-                        WHEN rates.type = 'Consumption' 
-                            AND (rates.product_name LIKE '%Windows')
+                        WHEN rates.os = 'Windows' AND rates.type = 'Consumption'
                             AND rates.savings_plan_term_1y = '1 Year'
                         THEN rates.savings_plan_unit_price_1y
                     END) AS Windows_Savings_Price_1_Year,
                 MAX(CASE 
-                        WHEN rates.type = 'Consumption' 
-                            AND (rates.product_name LIKE '%Windows')
-                            AND rates.savings_plan_term_3y ='3 Years'
+                        WHEN rates.os = 'Windows' AND rates.type = 'Consumption'
+                            AND rates.savings_plan_term_3y = '3 Years'
                         THEN rates.savings_plan_unit_price_3y
                     END) AS Windows_Savings_Price_3_Years,
                 MAX(CASE 
-                        WHEN ((rates.reservation_term = '1 Year') 
-                            AND rates.type = 'Reservation') 
-                            AND (rates.product_name LIKE '%Windows')
+                        WHEN rates.os = 'Windows' AND rates.pricing_kind = 'reservation' AND rates.term_years = 1
                         THEN rates.unit_price / 8760
                     END) AS Windows_Reservation_1_Year,
                 MAX(CASE 
-                        WHEN ((rates.reservation_term = '3 Years') 
-                            AND rates.type = 'Reservation') 
-                            AND (rates.product_name LIKE '%Windows')
+                        WHEN rates.os = 'Windows' AND rates.pricing_kind = 'reservation' AND rates.term_years = 3
                         THEN rates.unit_price / (3 * 8760)
                     END) AS Windows_Reservation_3_Years,
                 MAX(CASE 
-                        WHEN ((rates.sku_name LIKE '%Spot' OR ARRAY_LENGTH(REGEXP_SPLIT_TO_ARRAY(rates.sku_name, '\\s+'), 1) = 3) 
-                            AND rates.type = 'Consumption') 
-                            AND rates.product_name LIKE '%Windows' 
+                        WHEN rates.os = 'Windows' AND (rates.pricing_kind = 'spot'
+                            OR (rates.pricing_kind = 'low-priority'
+                                AND ARRAY_LENGTH(REGEXP_SPLIT_TO_ARRAY(rates.sku_name, '\\s+'), 1) = 3))
                         THEN rates.unit_price
                     END) AS Windows_Spot_Cost
             FROM 
@@ -1940,19 +2320,56 @@ def insert_into_vm_pricing_join_operation():
             GROUP BY 
                 vm.name, vm.locations, vm.memorygb, vm.vcpus, vm.gpus
             ORDER BY 
-                vm.locations ASC, vm.name ASC;
+                vm.locations ASC, vm.name ASC
         """
+
+def plan_index_names(plan):
+    """Return the names of the indexes scanned anywhere in an EXPLAIN (FORMAT JSON) plan node"""
+
+    names = {plan['Index Name']} if 'Index Name' in plan else set()
+    for child in plan.get('Plans', ()):
+        names |= plan_index_names(child)
+    return names
+
+def explain_vm_pricing_join():
+    """Log the plan of the vm_pricing join and return the managed indexes it scans"""
+
+    managed = {index for table in ('azure_rates', 'virtualMachines') for index, _ in MANAGED_INDEXES[table]}
+    try:
+        pgcur.execute("EXPLAIN (FORMAT JSON) " + VM_PRICING_JOIN_QUERY)
+        plan = pgcur.fetchone()[0][0]['Plan']
+    except psycopg2.Error as e:
+        logging.error(f"Error in explaining the vm_pricing join:{e}")
+        return None
+    used = plan_index_names(plan) & managed
+    logging.info(f"vm_pricing join plan: {json.dumps(plan)}")
+    if managed - used:
+        logging.warning(f"vm_pricing join does not scan the indexes {sorted(managed - used)}")
+    return used
+
+@measured('insert')
+def insert_into_vm_pricing_join_operation():
+    """Insert into the vm_pricing table"""
+
+    query = "INSERT INTO vm_pricing " + VM_PRICING_JOIN_QUERY
     try:
         pgcur.execute(query)
         logging.info("Data inserted into vm_pricing table")
+        return True
     except psycopg2.Error as e:
         logging.critical(f"Error in inserting data into vm_pricing table:{e}")
+        return False
 
-def create_table_vm_pricing_history():
-    """Create vm_pricing_history table for storing historical data"""
+def notify_vm_pricing_refreshed():
+    """Tell the listeners of vm_pricing_refreshed, such as vmmatrix, that vm_pricing holds a new run"""
 
-    query = """
-        CREATE TABLE IF NOT EXISTS vm_pricing_history(
+    try:
+        pgcur.execute("NOTIFY vm_pricing_refreshed")
+        logging.info("Notified : vm_pricing_refreshed")
+    except psycopg2.Error as e:
+        logging.error(f"Error in notifying vm_pricing_refreshed:{e}")
+
+VM_PRICING_HISTORY_COLUMNS = """
                     Name VARCHAR,
                     Location VARCHAR,
                     Instance_memory NUMERIC,
@@ -1970,23 +2387,198 @@ def create_table_vm_pricing_history():
                     Windows_Reservation_1_Year NUMERIC,
                     Windows_Reservation_3_Years  NUMERIC,
                     Windows_Spot_Cost NUMERIC,
-                    run_timestamp TIMESTAMP)
-            """
+                    run_timestamp TIMESTAMP"""
+
+def vm_pricing_history_relkind():
+    """Return the pg_class relkind of vm_pricing_history, None when it does not exist"""
+
+    pgcur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('vm_pricing_history')")
+    row = pgcur.fetchone()
+    return row[0] if row else None
+
+def vm_pricing_history_partition_statement(month):
+    """Return the statement creating the partition of vm_pricing_history for the month starting at month"""
+
+    following = month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+    return ("CREATE TABLE IF NOT EXISTS vm_pricing_history_p%s PARTITION OF vm_pricing_history "
+            "FOR VALUES FROM ('%s') TO ('%s')" % (month.strftime('%Y%m'), month.date(), following.date()))
+
+def create_table_vm_pricing_history():
+    """Create vm_pricing_history table for storing historical data, partitioned by month of run_timestamp
+
+    A vm_pricing_history table left unpartitioned by earlier releases is
+    moved into the monthly partitions in a single transaction.
+    """
+
+    create_query = "CREATE TABLE IF NOT EXISTS vm_pricing_history(%s) PARTITION BY RANGE (run_timestamp)" % VM_PRICING_HISTORY_COLUMNS
+    index_query = "CREATE INDEX IF NOT EXISTS vm_pricing_history_name_location_run ON vm_pricing_history (Name, Location, run_timestamp)"
     try:
-        pgcur.execute(query)
+        if vm_pricing_history_relkind() == 'r':
+            migrate_vm_pricing_history(create_query)
+        pgcur.execute(create_query)
+        pgcur.execute(index_query)
         logging.info("Table Created: vm_pricing_history")
     except psycopg2.Error as e:
         logging.error(f"Error creating table vm_pricing_history:{e}")
 
+def migrate_vm_pricing_history(create_query):
+    """Move the rows of an unpartitioned vm_pricing_history into a monthly partitioned one
+
+    Legacy rows without a run_timestamp go to the DEFAULT partition
+    vm_pricing_history_default, which retention never drops.
+    """
+
+    try:
+        pgcur.execute("BEGIN")
+        pgcur.execute("ALTER TABLE vm_pricing_history RENAME TO vm_pricing_history_unpartitioned")
+        pgcur.execute(create_query)
+        pgcur.execute("""SELECT DISTINCT date_trunc('month', run_timestamp) FROM vm_pricing_history_unpartitioned
+                         WHERE run_timestamp IS NOT NULL""")
+        for (month,) in pgcur.fetchall():
+            pgcur.execute(vm_pricing_history_partition_statement(month))
+        pgcur.execute("SELECT COUNT(*) FROM vm_pricing_history_unpartitioned WHERE run_timestamp IS NULL")
+        untimed = pgcur.fetchone()[0]
+        if untimed:
+            pgcur.execute("CREATE TABLE IF NOT EXISTS vm_pricing_history_default PARTITION OF vm_pricing_history DEFAULT")
+            logging.warning(f"Moving {untimed} vm_pricing_history rows without run_timestamp into vm_pricing_history_default")
+        pgcur.execute("INSERT INTO vm_pricing_history SELECT * FROM vm_pricing_history_unpartitioned")
+        migrated = pgcur.rowcount
+        pgcur.execute("DROP TABLE vm_pricing_history_unpartitioned")
+        pgcur.execute("COMMIT")
+        logging.info(f"Moved {migrated} rows into the partitioned vm_pricing_history")
+    except psycopg2.Error as e:
+        pgcur.execute("ROLLBACK")
+        logging.critical(f"Error in partitioning vm_pricing_history, keeping it unpartitioned:{e}")
+
+def create_vm_pricing_history_partitions():
+    """Create the vm_pricing_history partitions of the current and the next month"""
+
+    try:
+        pgcur.execute("SELECT date_trunc('month', LOCALTIMESTAMP), date_trunc('month', LOCALTIMESTAMP + INTERVAL '1 month')")
+        # the next month is created ahead, a run started just before midnight may insert after it
+        for month in pgcur.fetchone():
+            pgcur.execute(vm_pricing_history_partition_statement(month))
+        logging.info("Partitions created : vm_pricing_history")
+    except psycopg2.Error as e:
+        logging.error(f"Error in creating partitions of vm_pricing_history:{e}")
+
+def drop_expired_vm_pricing_history_partitions(retention_months=None):
+    """Drop the vm_pricing_history partitions ending before the retention window"""
+
+    if retention_months is None:
+        retention_months = VM_PRICING_HISTORY_RETENTION_MONTHS
+    if retention_months <= 0:
+        return
+    try:
+        pgcur.execute("""SELECT child.relname FROM pg_inherits
+                         JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                         WHERE pg_inherits.inhparent = 'vm_pricing_history'::regclass
+                           AND child.relname ~ '^vm_pricing_history_p[0-9]{6}$'
+                           AND to_date(right(child.relname, 6), 'YYYYMM')
+                               < date_trunc('month', LOCALTIMESTAMP) - %s * INTERVAL '1 month'
+                         ORDER BY child.relname""", (retention_months - 1,))
+        for (partition,) in pgcur.fetchall():
+            pgcur.execute("DROP TABLE %s" % partition)
+            logging.info(f"Dropped expired partition : {partition}")
+    except psycopg2.Error as e:
+        logging.error(f"Error in dropping expired partitions of vm_pricing_history:{e}")
+
 def insert_into_vm_pricing_history():
     """Insert vm_pricing table data along eith timesatmp to store the historical data"""
 
+    create_vm_pricing_history_partitions()
     query = "Insert into vm_pricing_history select *,CURRENT_TIMESTAMP from vm_pricing ;"
     try:
         pgcur.execute(query)
         logging.info("Data inserted into vm_pricing_history table")
     except psycopg2.Error as e:
         logging.critical(f"Error in inserting data into vm_pricing_history table:{e}")
+    drop_expired_vm_pricing_history_partitions()
+
+
+# vm_pricing columns compared to tell a new version of a row from the recorded one
+VM_PRICING_VALUE_COLUMNS = ('Instance_memory', 'vCPUs', 'Instance_Storage',
+                            'Linux_On_Demand_Cost', 'Linux_Savings_Price_1_Year', 'Linux_Savings_Price_3_Years',
+                            'Linux_Reservation_1_Year', 'Linux_Reservation_3_Years', 'Linux_Spot_Cost',
+                            'Windows_On_Demand_Cost', 'Windows_Savings_Price_1_Year', 'Windows_Savings_Price_3_Years',
+                            'Windows_Reservation_1_Year', 'Windows_Reservation_3_Years', 'Windows_Spot_Cost')
+
+def create_table_vm_pricing_versions():
+    """Create vm_pricing_versions table storing each version of a vm_pricing row with its validity interval
+
+    The open version of a row has a NULL valid_to, a lookup at a point in
+    time is one probe of the (name, location, valid_from) index.
+    """
+
+    query = """
+        CREATE TABLE IF NOT EXISTS vm_pricing_versions(
+                    Name VARCHAR,
+                    Location VARCHAR,
+                    Instance_memory NUMERIC,
+                    vCPUs INT,
+                    Instance_Storage NUMERIC,
+                    Linux_On_Demand_Cost NUMERIC,
+                    Linux_Savings_Price_1_Year NUMERIC,
+                    Linux_Savings_Price_3_Years NUMERIC,
+                    Linux_Reservation_1_Year NUMERIC,
+                    Linux_Reservation_3_Years NUMERIC,
+                    Linux_Spot_Cost NUMERIC,
+                    Windows_On_Demand_Cost NUMERIC,
+                    Windows_Savings_Price_1_Year NUMERIC,
+                    Windows_Savings_Price_3_Years NUMERIC,
+                    Windows_Reservation_1_Year NUMERIC,
+                    Windows_Reservation_3_Years  NUMERIC,
+                    Windows_Spot_Cost NUMERIC,
+                    valid_from TIMESTAMP NOT NULL,
+                    valid_to TIMESTAMP);
+        CREATE UNIQUE INDEX IF NOT EXISTS vm_pricing_versions_open
+            ON vm_pricing_versions (Name, Location) WHERE valid_to IS NULL;
+        CREATE INDEX IF NOT EXISTS vm_pricing_versions_name_location_valid_from
+            ON vm_pricing_versions (Name, Location, valid_from);
+            """
+    try:
+        pgcur.execute(query)
+        logging.info("Table Created: vm_pricing_versions")
+    except psycopg2.Error as e:
+        logging.error(f"Error creating table vm_pricing_versions:{e}")
+
+def insert_into_vm_pricing_versions():
+    """Record the vm_pricing rows that differ from their open version in vm_pricing_versions
+
+    Changed rows and rows gone from vm_pricing get their open version closed,
+    changed and new rows get a new open version, unchanged rows are left alone.
+    """
+
+    stored = ", ".join("v.%s" % column for column in VM_PRICING_VALUE_COLUMNS)
+    current = ", ".join("p.%s" % column for column in VM_PRICING_VALUE_COLUMNS)
+    close_query = """
+        UPDATE vm_pricing_versions v SET valid_to = LOCALTIMESTAMP
+        WHERE v.valid_to IS NULL
+          AND NOT EXISTS (SELECT 1 FROM vm_pricing p
+                          WHERE p.Name = v.Name AND p.Location = v.Location
+                            AND ROW(%s) IS NOT DISTINCT FROM ROW(%s))""" % (current, stored)
+    open_query = """
+        INSERT INTO vm_pricing_versions
+        SELECT DISTINCT ON (p.Name, p.Location) p.*, LOCALTIMESTAMP, NULL
+        FROM vm_pricing p
+        WHERE NOT EXISTS (SELECT 1 FROM vm_pricing_versions v
+                          WHERE v.valid_to IS NULL AND v.Name = p.Name AND v.Location = p.Location)"""
+    try:
+        pgcur.execute("SELECT EXISTS (SELECT 1 FROM vm_pricing)")
+        if not pgcur.fetchone()[0]:
+            logging.warning("vm_pricing is empty, keeping the open vm_pricing_versions")
+            return
+        # LOCALTIMESTAMP is fixed for the transaction, closed and opened versions meet exactly
+        pgcur.execute("BEGIN")
+        pgcur.execute(close_query)
+        closed = pgcur.rowcount
+        pgcur.execute(open_query)
+        opened = pgcur.rowcount
+        pgcur.execute("COMMIT")
+        logging.info(f"vm_pricing_versions: {closed} versions closed, {opened} versions opened")
+    except psycopg2.Error as e:
+        pgcur.execute("ROLLBACK")
+        logging.critical(f"Error in inserting data into vm_pricing_versions table:{e}")
 
 
 def close_db_connection():
@@ -2002,78 +2594,182 @@ def close_db_connection():
 
 
 
-def mainflow():
-    #Connect to database
-    connect_to_db() 
-    
-    #Process availability sets data
+def process_availabilitysets():
+    """Load the availability sets data"""
+
     create_table_availabilitysets()
-    truncate_table_availabilitysets()
     a_data = fetch_data_availabilitysets()
-    insert_into_availabilitysets(a_data)
+    with table_load('availabilitySets', truncate_table_availabilitysets):
+        insert_into_availabilitysets(a_data)
+
+def process_snapshots():
+    """Load the snapshots data"""
 
-    #Process snapshots data
     create_table_snapshots()
-    truncate_table_snapshots()
     s_data = fetch_data_snapshots()
-    insert_into_snapshots(s_data)
-    
+    with table_load('snapshots', truncate_table_snapshots):
+        insert_into_snapshots(s_data)
+
+def process_disks():
+    """Load the disks data"""
 
-    #Process disks data
     create_table_disks()
-    truncate_table_disks()
     d_data = fetch_data_disks()
-    insert_into_disks(d_data)
+    with table_load('disks', truncate_table_disks):
+        insert_into_disks(d_data)
+
+def process_hostgroups():
+    """Load the hostGroups/hosts data"""
 
-    #Process hostGroups/hosts data
     create_table_hostgroups()
-    truncate_table_hostgroups()
     h_data = fetch_data_hostgroups()
-    insert_into_hostgroup(h_data)
+    with table_load('hostGroups_hosts', truncate_table_hostgroups):
+        insert_into_hostgroup(h_data)
+
+def process_vms():
+    """Load the virtual machines data"""
 
-    #Process virtual machines data
     create_table_vms()
-    truncate_table_vms()
     v_data = fetch_data_vms()
-    insert_into_vms(v_data)
+    with table_load('virtualMachines', truncate_table_vms):
+        insert_into_vms(v_data)
 
-    #Process azure rates
-    create_table_azure_rates()
-    truncate_table_azure_rates()
-    """API url for the first page of Azure prices"""
-    api_url = "https://prices.azure.com/api/retail/prices?api-version=2023-01-01-preview"
+def process_azure_rates():
+    """Load the azure rates"""
 
-    while api_url:
-        try:
-            api_url,r_data = fetch_data_rates(api_url)
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Error fetching Azure VM rates : {e}")
-            logging.info(f"Retrying in 5 seconds...")
-            time.sleep(5)
-            api_url,r_data = fetch_data_rates(api_url)
+    create_table_azure_rates()
+    sync_azure_rates()
 
+def process_vm_pricing():
+    """Join the vm info and rates details into vm_pricing and its history"""
 
-        insert_into_azure_rates(r_data)
-    
-    #Process the vm info and rates details
     create_table_vm_pricing()
-    truncate_table_vm_pricing()
-    insert_into_vm_pricing_join_operation()
-    create_table_vm_pricing_history()
-    insert_into_vm_pricing_history()
-
-
+    if EXPLAIN_VM_PRICING:
+        explain_vm_pricing_join()
+    with table_load('vm_pricing', truncate_table_vm_pricing) as load:
+        inserted = insert_into_vm_pricing_join_operation()
+    if VM_PRICING_HISTORY_MODE == 'delta':
+        create_table_vm_pricing_versions()
+        insert_into_vm_pricing_versions()
+    else:
+        create_table_vm_pricing_history()
+        insert_into_vm_pricing_history()
+    # after the history too, vmprices reads it once notified
+    if inserted and load['replaced']:
+        notify_vm_pricing_refreshed()
+    else:
+        logging.warning("vm_pricing was not refreshed, not notifying vm_pricing_refreshed")
+
+def pipeline_stages():
+    """Return the pipeline stages with the names of the stages each one depends on"""
+
+    # The filtered crawl reads its regions from virtualMachines
+    rates_dependencies = ('vms',) if RATES_CRAWL_MODE == 'filtered' else ()
+    return {
+        'availabilitysets': (process_availabilitysets, ()),
+        'snapshots': (process_snapshots, ()),
+        'disks': (process_disks, ()),
+        'hostgroups': (process_hostgroups, ()),
+        'vms': (process_vms, ()),
+        'azure_rates': (process_azure_rates, rates_dependencies),
+        'vm_pricing': (process_vm_pricing, ('vms', 'azure_rates')),
+    }
+
+def run_stage(name, stage):
+    """Run one pipeline stage on its own database connection"""
+
+    started = time.perf_counter()
+    stage_context.name = name
+    connect_to_db()
+    try:
+        stage()
+    finally:
+        close_db_connection()
+        record_stage_metrics(seconds=time.perf_counter() - started)
+        stage_context.name = None
+    logging.info(f"Stage {name} finished in {time.perf_counter() - started:.1f}s")
+
+def run_stages(stages, workers=None):
+    """Run the stages concurrently, each one as soon as all of its dependencies have finished"""
+
+    workers = max(1, workers or PIPELINE_WORKERS)
+    pending = dict(stages)
+    running = {}
+    done = set()
+    failed = set()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='stage') as pool:
+        while pending or running:
+            for name, (stage, dependencies) in list(pending.items()):
+                if any(dependency in failed for dependency in dependencies):
+                    logging.critical(f"Skipping stage {name}, a stage it depends on failed")
+                    failed.add(name)
+                    del pending[name]
+                elif all(dependency in done for dependency in dependencies):
+                    running[pool.submit(run_stage, name, stage)] = name
+                    del pending[name]
+            if not running:
+                if pending:
+                    logging.critical(f"Stages {sorted(pending)} depend on unknown stages")
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    done.add(name)
+                except Exception as e:
+                    logging.critical(f"Stage {name} failed:{e}")
+                    failed.add(name)
+    return done, failed
 
-    #close database connection
-    close_db_connection()
+def mainflow():
+    """Run all pipeline stages, independent ones concurrently"""
+
+    started = time.perf_counter()
+    started_at = utc_now_text()
+    reset_resource_skus()
+    reset_run_metrics()
+    reset_sku_cache_stats()
+    if TABLE_LOAD_MODE == 'shadow':
+        connect_to_db()
+        try:
+            create_shadow_schemas()
+        finally:
+            close_db_connection()
+    done, failed = run_stages(pipeline_stages())
+    reset_resource_skus()
+    logging.info(f"Pipeline finished in {time.perf_counter() - started:.1f}s,"
+                 f" {len(done)} stages done, {len(failed)} failed")
+    logging.info(f"resource_skus cache: {sku_cache_stats}")
+    with run_metrics_lock:
+        stages = json.loads(json.dumps(run_metrics))
+    summary = {'started_at': started_at, 'finished_at': utc_now_text(),
+               'seconds': round(time.perf_counter() - started, 3),
+               'done': sorted(done), 'failed': sorted(failed),
+               'stages': stages, 'resource_skus_cache': dict(sku_cache_stats)}
+    logging.info(f"Run summary: {json.dumps(summary)}")
+    export_run_metrics(summary)
+    connect_to_db()
+    try:
+        create_table_pipeline_runs()
+        insert_into_pipeline_runs(summary)
+    finally:
+        close_db_connection()
 
 
 if __name__ == '__main__':
-  stackql = StackQL()
-  stackql_query = "REGISTRY PULL azure"
-  result = stackql.executeStmt(stackql_query)
+  if SKU_SOURCE not in SKU_SOURCES:
+    raise SystemExit(f"Unknown SKU_SOURCE {SKU_SOURCE!r}, expected one of {', '.join(SKU_SOURCES)}")
+
+  if SKU_SOURCE == 'stackql':
+    stackql = StackQL()
+    stackql_query = "REGISTRY PULL azure"
+    result = stackql.executeStmt(stackql_query)
 
-  subscription_id = os.environ["AZURE_SUBSCRIPTION_ID"]
+    subscription_id = os.environ["AZURE_SUBSCRIPTION_ID"]
+  else:
+    # file and synthetic SKU sources need neither credentials nor network
+    subscription_id = SKU_SOURCE
 
   # Set UTC Timezone in Python
   utc_timezone = 'UTC'
@@ -2087,6 +2783,7 @@ if __name__ == '__main__':
                 datefmt='%m/%d/%Y %I:%M:%S %p %Z',
                 level=LOGLEVEL,
                 force=True)
+  start_metrics_server()
   schedule.every().day.at("00:00").do(mainflow)
   schedule.run_all()
   while True: